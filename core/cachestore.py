@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from core.extractors import json_loads, json_dumps
+
+
+class CacheStore:
+    """
+    Single SQLite (WAL) database holding the villages, attacks, reports, farms and managed caches
+    The old cache/<table>/<id>.json layout is imported once on first open
+    """
+    path = os.path.join("cache", "cache.db")
+    connection = None
+    lock = threading.RLock()
+    logger = logging.getLogger("CacheStore")
+
+    tables = ["villages", "attacks", "reports", "managed"]
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE IF NOT EXISTS villages ("
+        "id TEXT PRIMARY KEY, owner TEXT, x INTEGER, y INTEGER, data TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS villages_location ON villages (x, y)",
+        "CREATE TABLE IF NOT EXISTS attacks ("
+        "id TEXT PRIMARY KEY, last_attack INTEGER, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS reports ("
+        "id TEXT PRIMARY KEY, type TEXT, origin TEXT, dest TEXT, created INTEGER, data TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS reports_created ON reports (created)",
+        "CREATE TABLE IF NOT EXISTS managed ("
+        "id TEXT PRIMARY KEY, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS farms ("
+        "id TEXT PRIMARY KEY, data TEXT NOT NULL)",
+    ]
+
+    @staticmethod
+    def get_connection():
+        with CacheStore.lock:
+            if CacheStore.connection:
+                return CacheStore.connection
+            directory = os.path.dirname(CacheStore.path)
+            if directory and not os.path.exists(directory):
+                os.mkdir(directory)
+            connection = sqlite3.connect(CacheStore.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in CacheStore.schema:
+                connection.execute(statement)
+            connection.commit()
+            CacheStore.connection = connection
+            CacheStore.migrate()
+            return connection
+
+    @staticmethod
+    def close():
+        with CacheStore.lock:
+            if CacheStore.connection:
+                CacheStore.connection.close()
+            CacheStore.connection = None
+
+    @staticmethod
+    def columns(table, key, entry):
+        # Indexed columns next to the raw json blob
+        if table == "villages":
+            location = entry.get("location") or [None, None]
+            return {"id": key, "owner": entry.get("owner"), "x": location[0], "y": location[1]}
+        if table == "attacks":
+            return {"id": key, "last_attack": entry.get("last_attack")}
+        if table == "reports":
+            return {
+                "id": key,
+                "type": entry.get("type"),
+                "origin": entry.get("origin"),
+                "dest": entry.get("dest"),
+                "created": int(time.time()),
+            }
+        return {"id": key}
+
+    @staticmethod
+    def get(table, key):
+        connection = CacheStore.get_connection()
+        with CacheStore.lock:
+            row = connection.execute(
+                "SELECT data FROM %s WHERE id = ?" % table, (str(key),)
+            ).fetchone()
+        if row:
+            return json_loads(row[0])
+        return None
+
+    @staticmethod
+    def set(table, key, entry):
+        CacheStore.set_many(table, {key: entry})
+
+    @staticmethod
+    def set_many(table, entries):
+        if not entries:
+            return
+        connection = CacheStore.get_connection()
+        rows = []
+        names = None
+        for key, entry in entries.items():
+            values = CacheStore.columns(table, str(key), entry)
+            values["data"] = json_dumps(entry)
+            names = list(values.keys())
+            rows.append([values[name] for name in names])
+        query = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (
+            table,
+            ", ".join(names),
+            ", ".join(["?"] * len(names)),
+        )
+        with CacheStore.lock:
+            connection.executemany(query, rows)
+            connection.commit()
+
+    @staticmethod
+    def delete(table, key):
+        connection = CacheStore.get_connection()
+        with CacheStore.lock:
+            connection.execute("DELETE FROM %s WHERE id = ?" % table, (str(key),))
+            connection.commit()
+
+    @staticmethod
+    def all(table):
+        connection = CacheStore.get_connection()
+        with CacheStore.lock:
+            rows = connection.execute("SELECT id, data FROM %s" % table).fetchall()
+        return {key: json_loads(data) for key, data in rows}
+
+    @staticmethod
+    def count(table):
+        connection = CacheStore.get_connection()
+        with CacheStore.lock:
+            return connection.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+
+    @staticmethod
+    def remove_oldest(table, keep):
+        # Only tables with a created column (reports) can be trimmed
+        connection = CacheStore.get_connection()
+        with CacheStore.lock:
+            removed = connection.execute(
+                "DELETE FROM %s WHERE id NOT IN "
+                "(SELECT id FROM %s ORDER BY created DESC, CAST(id AS INTEGER) DESC LIMIT ?)"
+                % (table, table),
+                (keep,),
+            ).rowcount
+            connection.commit()
+        return removed
+
+    @staticmethod
+    def snapshot(path):
+        # Consistent copy of the whole database, also while it is in WAL mode
+        connection = CacheStore.get_connection()
+        with CacheStore.lock:
+            target = sqlite3.connect(path)
+            connection.backup(target)
+            target.close()
+
+    @staticmethod
+    def get_meta(key):
+        connection = CacheStore.get_connection()
+        with CacheStore.lock:
+            row = connection.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def set_meta(key, value):
+        connection = CacheStore.get_connection()
+        with CacheStore.lock:
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value))
+            )
+            connection.commit()
+
+    @staticmethod
+    def migrate():
+        connection = CacheStore.connection
+        done = connection.execute(
+            "SELECT value FROM meta WHERE key = 'migrated'"
+        ).fetchone()
+        if done:
+            return
+        base = os.path.dirname(CacheStore.path)
+        total = 0
+        for table in CacheStore.tables:
+            c_path = os.path.join(base, table)
+            if not os.path.isdir(c_path):
+                continue
+            entries = {}
+            for existing in os.listdir(c_path):
+                if not existing.endswith(".json"):
+                    continue
+                t_path = os.path.join(c_path, existing)
+                try:
+                    with open(t_path, "r") as f:
+                        entry = json.load(f)
+                except ValueError:
+                    CacheStore.logger.warning("Skipping broken cache file %s" % t_path)
+                    continue
+                key = existing.replace(".json", "")
+                entries[key] = entry
+            if entries:
+                CacheStore.set_many(table, entries)
+                # Keep the file age for reports so trimming still removes the oldest first
+                if table == "reports":
+                    connection.executemany(
+                        "UPDATE reports SET created = ? WHERE id = ?",
+                        [
+                            (int(os.path.getctime(os.path.join(c_path, key + ".json"))), key)
+                            for key in entries
+                        ],
+                    )
+                total += len(entries)
+        connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)",
+            (str(int(time.time())),),
+        )
+        connection.commit()
+        if total:
+            CacheStore.logger.info("Migrated %d cache files into %s" % (total, CacheStore.path))
@@ -3,20 +3,177 @@ import json
 from datetime import datetime, timedelta
 import statistics
 
+try:
+    import orjson
+
+    has_orjson = True
+except ImportError:
+    has_orjson = False
+
+# Compiled once at import, every page of every village goes through these
+CSRF_TOKEN = re.compile(r'<meta content="(.+?)" name="csrf-token"')
+H_PARAM = re.compile(r"&h=(\w+)")
+BUILD_QUEUE = re.compile(r'(?s)<table id="build_queue"(.+?)</table>')
+BUILD_QUEUE_ITEM = re.compile(
+    r'<tr class=".+? buildorder_(.+?)"[ >].+?data-available-to="(.+?)"', re.M | re.S
+)
+VILLAGE_DATA = re.compile(r"var village = (.+);")
+GAME_DATA = re.compile(r"TribalWars\.updateGameData\((.+?)\);")
+BUILDING_DATA = re.compile(r"(?s)BuildingMain.buildings = (\{.+?\});")
+QUEST_DATA = re.compile(r"Quests.setQuestData\((\{.+?\})\);")
+QUEST_REWARDS = re.compile(r"RewardSystem\.setRewards\(\s*(\[\{.+?\}\]),")
+DAILY_BONUS = re.compile(r"DailyBonus.init\((\s+\{.*\}),")
+MAP_DATA = re.compile(r"(?s)TWMap.sectorPrefech = (\[(.+?)\]);")
+SMITH_DATA = re.compile(r"(?s)BuildingSmith.techs = (\{.+?\});")
+PREMIUM_DATA = re.compile(r"(?s)PremiumExchange.receiveData\((.+?)\);")
+PREMIUM_RATES = re.compile(r"data: (\[\[.+\]\]),")
+RECRUIT_DATA = re.compile(r"(?s)unit_managers.units = (\{.+?\});")
+QUOTE_KEYS = re.compile(r"([\{\s,])(\w+)(:)")
+UNITS_HOME = re.compile(r'(?s)<table id="units_home".+?</table>')
+UNIT_LINK = re.compile(r'(?s)<a href="#" class="unit_link" data-unit="(\w+)".+?(\d+)</strong>')
+RECRUIT_CANCEL = re.compile(r"(?s)TrainOverview\.cancelOrder\((\d+)\)")
+TRAIN_QUEUE = re.compile(r'(?s)<div class="trainqueue_wrap"(.+?)</tbody>')
+TRAIN_QUEUE_ITEM = re.compile(
+    r'class="unit_sprite unit_sprite_smaller (.+?)">.+?div>.+?(\d+).+<td class="lit-item">.+? (\d{2}:\d{2}:\d{2})',
+    re.M | re.S,
+)
+OUTGOING_COMMANDS = re.compile(r'(?s)<div id="commands_outgoings"(.+?)</tbody>')
+COMMAND_ITEM = re.compile(r'data-command-type="(.+?)">.+?data-endtime="(\d+)"', re.M | re.S)
+QUICKEDIT_VILLAGE = re.compile(r'<span class="quickedit-vn" data-id="(\d+)"')
+GREY_SEPARATOR = re.compile(r'<span class="grey">\.</span>')
+PRODUCTION_TABLE = re.compile(r'(?s)<table id="production_table".+?</table>')
+TABLE_ROW = re.compile(r"(?s)<tr[^>]*>(.+?)</tr>")
+TABLE_CELL = re.compile(r"(?s)<td[^>]*>(.*?)</td>")
+HTML_TAG = re.compile(r"<[^>]+>")
+NUMBER = re.compile(r"\d+")
+FARM_SPACE = re.compile(r"^\s*(\d+)\s*/\s*(\d+)\s*$")
+DATA_TEXT = re.compile(r'data-text="(.+?)"')
+QUICKEDIT_LABEL = re.compile(r'(?s)<span class="quickedit-label"[^>]*>(.+?)</span>')
+UNITS_TABLE = re.compile(r'(?s)<table id="units_table".+?</table>')
+UNIT_HEADER = re.compile(r'unit_(\w+?)(?:@2x)?\.(?:png|webp)|data-unit="(\w+)"')
+QUICKEDIT_SPLIT = re.compile(r'<span class="quickedit-vn" data-id="')
+UNIT_ITEM_COUNT = re.compile(r'(?s)<td class="unit-item[^"]*"[^>]*>\s*(\d+)\s*</td>')
+INCOMINGS_TABLE = re.compile(r'(?s)<table id="incomings_table".+?</table>')
+OVERVIEW_LINK = re.compile(r"village=(\d+)&(?:amp;)?screen=overview\b")
+END_TIME = re.compile(r'data-endtime="(\d+)"')
+OTHER_VILLAGE_ROW = re.compile(r'(?s)<span class="village_anchor.+?</tr>')
+UNIT_ITEM = re.compile(r"(?s)class=\Wunit-item unit-item-([a-z]+)\W.+?(\d+)</td>")
+FORM_INPUT = re.compile(r'(?s)<input.+?name="(.+?)".+?value="(.*?)"')
+DURATION = re.compile(r'<span class="relative_time" data-duration="(\d+)"')
+REPORT_LINK = re.compile(r'(?s)class="report-link" data-id="(\d+)"')
+CONTINENT = re.compile(r"(K\d+)")
+ROW_ICON = re.compile(r"graphic/([\w/]+?)\.(?:png|webp)")
+FARM_TEMPLATES = re.compile(r"(?s)Accountmanager\.farm\.templates\s*=\s*(\{.+?\});")
+FARM_TEMPLATE_FORM = re.compile(r'(?s)<form[^>]+action="([^"]*edit_all[^"]*)"[^>]*>(.+?)</form>')
+SCAVENGE_OPTION = re.compile(
+    r'"id":(\d+),"name":"[^"]*","(?:loot_factor|ratio)":([\d.]+),"duration_exponent":([\d.]+),'
+    r'"duration_initial_seconds":([\d.]+),"duration_factor":([\d.]+)'
+)
+MERCHANTS_AVAILABLE = re.compile(r'market_merchant_available_count">(\d+)')
+
+
+def json_loads(data):
+    # orjson refuses control characters inside strings which the game sometimes sends, stdlib handles those
+    if has_orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data, strict=False)
+
+
+def json_dumps(data):
+    if has_orjson:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(data)
+
+
+def findall_outside(pattern, exclude, text):
+    # Same as pattern.findall(exclude.sub("", text)) without building the stripped copy of the page
+    output = []
+    start = 0
+    for skipped in exclude.finditer(text):
+        output.extend(pattern.findall(text, start, skipped.start()))
+        start = skipped.end()
+    output.extend(pattern.findall(text, start))
+    return output
+
+
+class ParsedPage:
+    """
+    Response body wrapper that extracts every field at most once
+    The page is kept on the response object so every consumer of that response shares it
+    """
+    text = None
+    fields = {}
+
+    def __init__(self, text):
+        self.text = text
+        self.fields = {}
+
+    @staticmethod
+    def of(res):
+        if type(res) == str:
+            return ParsedPage(res)
+        page = getattr(res, "parsed_page", None)
+        if page is None:
+            page = ParsedPage(res.text)
+            res.parsed_page = page
+        return page
+
+    def get(self, field, parser):
+        if field not in self.fields:
+            self.fields[field] = parser(self.text)
+        return self.fields[field]
+
+    @property
+    def csrf_token(self):
+        return self.get("csrf_token", Extractor.parse_csrf_token)
+
+    @property
+    def h(self):
+        return self.get("h", Extractor.parse_h)
+
+    @property
+    def game_state(self):
+        return self.get("game_state", Extractor.parse_game_state)
+
+    @property
+    def units_in_village(self):
+        return self.get("units_in_village", Extractor.parse_units_in_village)
+
+    @property
+    def active_attacks(self):
+        return self.get("active_attacks", Extractor.parse_active_attacks)
+
+    @property
+    def daily_reward(self):
+        return self.get("daily_reward", Extractor.parse_daily_reward)
+
 
 class Extractor:
+    @staticmethod
+    def parse_csrf_token(res):
+        xsrf = CSRF_TOKEN.search(res)
+        if xsrf:
+            return xsrf.group(1)
+        return None
+
+    @staticmethod
+    def parse_h(res):
+        get_h = H_PARAM.search(res)
+        if get_h:
+            return get_h.group(1)
+        return None
+
     @staticmethod
     def new_active_building_queue(res):
         if type(res) != str:
             res = res.text
-        builder = re.search('(?s)<table id="build_queue"(.+?)</table>', res)
+        builder = BUILD_QUEUE.search(res)
         if builder is None:
             return [], []
-        p = re.compile(
-            r'<tr class=".+? buildorder_(.+?)"[ >].+?data-available-to="(.+?)"',
-            re.M | re.S,
-        )
-        queued = re.findall(p, builder.group(1))
+        queued = BUILD_QUEUE_ITEM.findall(builder.group(1))
 
         current_ts = []
         buildings_q = []
@@ -30,27 +187,46 @@ class Extractor:
     def village_data(res):
         if type(res) != str:
             res = res.text
-        grabber = re.search(r"var village = (.+);", res)
+        grabber = VILLAGE_DATA.search(res)
         if grabber:
             data = grabber[1]
-            return json.loads(data, strict=False)
+            return json_loads(data)
 
     @staticmethod
-    def game_state(res):
+    def scavenge_options(res):
+        """
+        Loot factor and duration parameters of every scavenging option from the ScavengeScreen data
+        """
         if type(res) != str:
             res = res.text
-        grabber = re.search(r"TribalWars\.updateGameData\((.+?)\);", res)
+        output = {}
+        for option, loot_factor, exponent, initial, factor in SCAVENGE_OPTION.findall(res):
+            output[int(option)] = {
+                "loot_factor": float(loot_factor),
+                "duration_exponent": float(exponent),
+                "duration_initial_seconds": float(initial),
+                "duration_factor": float(factor),
+            }
+        return output
+
+    @staticmethod
+    def game_state(res):
+        return ParsedPage.of(res).game_state
+
+    @staticmethod
+    def parse_game_state(res):
+        grabber = GAME_DATA.search(res)
         if grabber:
             data = grabber[1]
-            return json.loads(data, strict=False)
+            return json_loads(data)
 
     @staticmethod
     def building_data(res):
         if type(res) != str:
             res = res.text
-        dre = re.search(r"(?s)BuildingMain.buildings = (\{.+?\});", res)
+        dre = BUILDING_DATA.search(res)
         if dre:
-            return json.loads(dre[1], strict=False)
+            return json_loads(dre[1])
 
         return None
 
@@ -58,9 +234,9 @@ class Extractor:
     def get_quests(res):
         if type(res) != str:
             res = res.text
-        get_quests = re.search(r"Quests.setQuestData\((\{.+?\})\);", res)
+        get_quests = QUEST_DATA.search(res)
         if get_quests:
-            result = json.loads(get_quests[1], strict=False)
+            result = json_loads(get_quests[1])
             for quest in result:
                 data = result[quest]
                 if data["goals_completed"] == data["goals_total"]:
@@ -71,10 +247,10 @@ class Extractor:
     def get_quest_rewards(res):
         if type(res) != str:
             res = res.text
-        get_rewards = re.search(r"RewardSystem\.setRewards\(\s*(\[\{.+?\}\]),", res)
+        get_rewards = QUEST_REWARDS.search(res)
         rewards = []
         if get_rewards:
-            result = json.loads(get_rewards[1], strict=False)
+            result = json_loads(get_rewards[1])
             for reward in result:
                 if reward["status"] == "unlocked":
                     rewards.append(reward)
@@ -83,10 +259,12 @@ class Extractor:
 
     @staticmethod
     def get_daily_reward(res):
-        if type(res) != str:
-            res = res.text
-        get_daily = re.search(r'DailyBonus.init\((\s+\{.*\}),', res)
-        res = json.loads(get_daily[1])
+        return ParsedPage.of(res).daily_reward
+
+    @staticmethod
+    def parse_daily_reward(res):
+        get_daily = DAILY_BONUS.search(res)
+        res = json_loads(get_daily[1])
         reward_count_unlocked = str(res["reward_count_unlocked"])
         if (
             reward_count_unlocked and
@@ -100,38 +278,38 @@ class Extractor:
     def map_data(res):
         if type(res) != str:
             res = res.text
-        data = re.search(r"(?s)TWMap.sectorPrefech = (\[(.+?)\]);", res)
+        data = MAP_DATA.search(res)
         if data:
-            return json.loads(data[1], strict=False)
+            return json_loads(data[1])
 
     @staticmethod
     def smith_data(res):
         if type(res) != str:
             res = res.text
-        data = re.search(r"(?s)BuildingSmith.techs = (\{.+?\});", res)
+        data = SMITH_DATA.search(res)
         if data:
-            return json.loads(data[1], strict=False)
+            return json_loads(data[1])
         return None
 
     @staticmethod
     def premium_data(res):
         if type(res) != str:
             res = res.text
-        data = re.search(r"(?s)PremiumExchange.receiveData\((.+?)\);", res)
+        data = PREMIUM_DATA.search(res)
         if data:
-            return json.loads(data[1], strict=False)
+            return json_loads(data[1])
         return None
 
     @staticmethod
     def premium_exchange_rate(res):
         if type(res) != str:
             res = res.text
-        data = re.findall(r'data: (\[\[.+\]\]),', res)
+        data = PREMIUM_RATES.findall(res)
         rate = {"wood": [], "stone": [], "iron": []}
         i = 0
         for x in data:
             # convert string output to list
-            res = json.loads(x)
+            res = json_loads(x)
             i += 1
             # resources have always a static order
             resource = "wood" if i == 1 else "stone" if i == 2 else "iron"
@@ -141,6 +319,15 @@ class Extractor:
             rate[resource] = int(statistics.mean(temp_rate))
         return rate
 
+    @staticmethod
+    def merchants_available(res):
+        if type(res) != str:
+            res = res.text
+        data = MERCHANTS_AVAILABLE.search(res)
+        if data:
+            return int(data.group(1))
+        return 0
+
 
     @staticmethod
     def premium_data_confirm(res):
@@ -153,27 +340,25 @@ class Extractor:
     def recruit_data(res):
         if type(res) != str:
             res = res.text
-        data = re.search(r"(?s)unit_managers.units = (\{.+?\});", res)
+        data = RECRUIT_DATA.search(res)
         if data:
             raw = data[1]
-            quote_keys_regex = r"([\{\s,])(\w+)(:)"
-            processed = re.sub(quote_keys_regex, r'\1"\2"\3', raw)
-            return json.loads(processed, strict=False)
+            processed = QUOTE_KEYS.sub(r'\1"\2"\3', raw)
+            return json_loads(processed)
 
     @staticmethod
     def units_in_village(res):
-        if type(res) != str:
-            res = res.text
-        res = re.sub('(?s)<table id="units_home".+?</table>', "", res)
-        return re.findall(
-            r'(?s)<a href="#" class="unit_link" data-unit="(\w+)".+?(\d+)</strong>', res
-        )
+        return ParsedPage.of(res).units_in_village
+
+    @staticmethod
+    def parse_units_in_village(res):
+        return findall_outside(UNIT_LINK, UNITS_HOME, res)
 
     @staticmethod
     def active_building_queue(res):
         if type(res) != str:
             res = res.text
-        builder = re.search('(?s)<table id="build_queue"(.+?)</table>', res)
+        builder = BUILD_QUEUE.search(res)
         if not builder:
             return 0
 
@@ -183,18 +368,14 @@ class Extractor:
     def active_recruit_queue(res):
         if type(res) != str:
             res = res.text
-        return re.findall(r"(?s)TrainOverview\.cancelOrder\((\d+)\)", res)
+        return RECRUIT_CANCEL.findall(res)
 
     @staticmethod
     def new_active_recruit_queue(res):
         if type(res) != str:
             res = res.text
-        builder = re.search('(?s)<div class="trainqueue_wrap"(.+?)<\/tbody>', res)
-        p = re.compile(
-            r'class="unit_sprite unit_sprite_smaller (.+?)">.+?div>.+?(\d+).+<td class="lit-item">.+? (\d{2}:\d{2}:\d{2})',
-            re.M | re.S,
-        )
-        queued = re.findall(p, builder.group(1))
+        builder = TRAIN_QUEUE.search(res)
+        queued = TRAIN_QUEUE_ITEM.findall(builder.group(1))
         previous_time = None
         current_ts = []
         units_q = []
@@ -215,15 +396,16 @@ class Extractor:
 
     @staticmethod
     def active_attacks(res):
-        if type(res) != str:
-            res = res.text
-        builder = re.search('(?s)<div id="commands_outgoings"(.+?)<\/tbody>', res)
+        # Callers consume these lists, hand out copies of the shared ones
+        outgoing, returning = ParsedPage.of(res).active_attacks
+        return list(outgoing), list(returning)
+
+    @staticmethod
+    def parse_active_attacks(res):
+        builder = OUTGOING_COMMANDS.search(res)
         if not builder:
             return [], []
-        p = re.compile(
-            r'data-command-type="(.+?)">.+?data-endtime="(\d+)"', re.M | re.S
-        )
-        queued = re.findall(p, builder.group(1))
+        queued = COMMAND_ITEM.findall(builder.group(1))
         outgoing = []
         returning = []
         for attack_or_return, timestr in queued:
@@ -238,31 +420,133 @@ class Extractor:
     def village_ids_from_overview(res):
         if type(res) != str:
             res = res.text
-        villages = re.findall(r'<span class="quickedit-vn" data-id="(\d+)"', res)
+        villages = QUICKEDIT_VILLAGE.findall(res)
         return list(set(villages))
 
+    @staticmethod
+    def production_overview(res):
+        """
+        Resources, storage and population of every own village from overview_villages&mode=prod
+        """
+        if type(res) != str:
+            res = res.text
+        output = {}
+        # Thousand separators are rendered as <span class="grey">.</span>
+        table = PRODUCTION_TABLE.search(res)
+        if table:
+            res = table.group(0)
+        res = GREY_SEPARATOR.sub("", res)
+        for row in TABLE_ROW.findall(res):
+            vid = QUICKEDIT_VILLAGE.search(row)
+            if not vid:
+                continue
+            cells = TABLE_CELL.findall(row)
+            res_cell = None
+            for num, cell in enumerate(cells):
+                if "wood" in cell and "stone" in cell and "iron" in cell:
+                    res_cell = num
+                    break
+            if res_cell is None or res_cell + 1 >= len(cells):
+                continue
+            resources = NUMBER.findall(HTML_TAG.sub(" ", cells[res_cell]))
+            storage = NUMBER.search(HTML_TAG.sub(" ", cells[res_cell + 1]))
+            farm = None
+            for cell in cells[res_cell + 1:]:
+                found = FARM_SPACE.search(HTML_TAG.sub("", cell))
+                if found:
+                    farm = found
+            if len(resources) < 3 or not storage or not farm:
+                continue
+            name = DATA_TEXT.search(row)
+            label = QUICKEDIT_LABEL.search(row)
+            output[vid.group(1)] = {
+                "id": vid.group(1),
+                "name": name.group(1) if name else vid.group(1),
+                "display_name": label.group(1).strip() if label else None,
+                "wood": int(resources[0]),
+                "stone": int(resources[1]),
+                "iron": int(resources[2]),
+                "storage_max": int(storage.group(0)),
+                "pop": int(farm.group(1)),
+                "pop_max": int(farm.group(2)),
+            }
+        return output
+
+    @staticmethod
+    def units_overview(res):
+        """
+        Troops at home and in total of every own village from overview_villages&mode=units
+        Each village block lists its own units first and the total last
+        """
+        if type(res) != str:
+            res = res.text
+        output = {}
+        table = UNITS_TABLE.search(res)
+        if not table:
+            return output
+        table = table.group(0)
+        header = TABLE_ROW.search(table)
+        units = []
+        for found in UNIT_HEADER.findall(header.group(1)):
+            unit = found[0] or found[1]
+            if unit not in units:
+                units.append(unit)
+        blocks = QUICKEDIT_SPLIT.split(table)[1:]
+        for block in blocks:
+            vid = NUMBER.match(block).group(0)
+            rows = []
+            for row in block.split("</tr>"):
+                counts = UNIT_ITEM_COUNT.findall(row)
+                if counts:
+                    rows.append(counts)
+            if not rows:
+                continue
+            output[vid] = {
+                "home": {unit: int(amount) for unit, amount in zip(units, rows[0])},
+                "total": {unit: int(amount) for unit, amount in zip(units, rows[-1])},
+            }
+        return output
+
+    @staticmethod
+    def incomings_overview(res):
+        """
+        Arrival times of incoming commands per target village from overview_villages&mode=incomings
+        """
+        if type(res) != str:
+            res = res.text
+        output = {}
+        table = INCOMINGS_TABLE.search(res)
+        if not table:
+            return output
+        for row in TABLE_ROW.findall(table.group(0)):
+            target = OVERVIEW_LINK.search(row)
+            arrival = END_TIME.search(row)
+            if not target or not arrival:
+                continue
+            output.setdefault(target.group(1), []).append(int(arrival.group(1)))
+        for times in output.values():
+            times.sort()
+        return output
+
     @staticmethod
     def units_in_total(res):
         if type(res) != str:
             res = res.text
         # hide units from other villages
-        res = re.sub(r'(?s)<span class="village_anchor.+?</tr>', "", res)
-        return re.findall(
-            r"(?s)class=\Wunit-item unit-item-([a-z]+)\W.+?(\d+)</td>", res
-        )
+        return findall_outside(UNIT_ITEM, OTHER_VILLAGE_ROW, res)
 
     @staticmethod
     def attack_form(res):
         if type(res) != str:
             res = res.text
-        data = re.findall(r'(?s)<input.+?name="(.+?)".+?value="(.*?)"', res)
+        data = FORM_INPUT.findall(res)
         return data
 
     @staticmethod
     def attack_duration(res):
         if type(res) != str:
             res = res.text
-        data = re.search(r'<span class="relative_time" data-duration="(\d+)"', res)
+        data = DURATION.search(res)
         if data:
             return int(data[1])
         return 0
@@ -271,11 +555,54 @@ class Extractor:
     def report_table(res):
         if type(res) != str:
             res = res.text
-        data = re.findall(r'(?s)class="report-link" data-id="(\d+)"', res)
+        data = REPORT_LINK.findall(res)
         return data
 
+    @staticmethod
+    def farm_templates(res):
+        """
+        Loot assistant (am_farm) templates in page order, the first one is A and the second one B
+        """
+        if type(res) != str:
+            res = res.text
+        data = FARM_TEMPLATES.search(res)
+        if not data:
+            return []
+        output = []
+        for entry in json_loads(data[1]).values():
+            units = {}
+            for k, v in entry.items():
+                if k != "id" and str(v).isdigit():
+                    units[k] = int(v)
+            output.append({"id": str(entry["id"]), "units": units})
+        return output
+
+    @staticmethod
+    def farm_template_form(res):
+        if type(res) != str:
+            res = res.text
+        form = FARM_TEMPLATE_FORM.search(res)
+        if not form:
+            return None, []
+        return form.group(1).replace("&amp;", "&"), FORM_INPUT.findall(form.group(2))
+
+    @staticmethod
+    def report_rows(res):
+        """
+        (report id, icons) of every row in the report list, newest first
+        Icons are image paths like dots/green or command/support
+        """
+        if type(res) != str:
+            res = res.text
+        output = []
+        for row in TABLE_ROW.findall(res):
+            report_id = REPORT_LINK.search(row)
+            if report_id:
+                output.append((report_id.group(1), ROW_ICON.findall(row)))
+        return output
+
     @staticmethod
     def continent(res):
-        continent = re.search(r'(K\d+)', res)
+        continent = CONTINENT.search(res)
         if continent:
             return continent[0]
\ No newline at end of file
@@ -0,0 +1,131 @@
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+from core.cachestore import CacheStore
+
+
+# Parameters that change on every request (timestamps, csrf hashes) and are left out of the replay key
+VOLATILE_PARAMS = ["e", "h", "_"]
+# Session cookies are not stored in archives that get shared
+PRIVATE_HEADERS = ["set-cookie", "cookie"]
+
+
+def replay_key(method, url):
+    parsed = urlparse(url)
+    params = [(k, v) for k, v in parse_qsl(parsed.query) if k not in VOLATILE_PARAMS]
+    return "%s %s%s?%s" % (method.upper(), parsed.netloc, parsed.path, urlencode(sorted(params)))
+
+
+def snapshot_path(path):
+    # cache/recordings/session_<ts>.jsonl.gz -> cache/recordings/session_<ts>.db
+    return path.replace(".jsonl.gz", "") + ".db"
+
+
+def replay_cache(path):
+    """
+    Copy of the cache snapshot taken when the recording started, so every replay starts from the
+    same state and the live cache is left alone
+    """
+    target = os.path.join(tempfile.mkdtemp(prefix="twb_replay_"), "cache.db")
+    snapshot = snapshot_path(path)
+    if os.path.exists(snapshot):
+        shutil.copyfile(snapshot, target)
+    else:
+        logging.getLogger("Replay").warning(
+            "No cache snapshot at %s, replaying with an empty cache" % snapshot
+        )
+    return target
+
+
+class SessionRecorder:
+    """
+    Appends every request/response pair of a WebWrapper session to a gzipped json-lines archive
+    """
+    path = None
+    logger = logging.getLogger("Recorder")
+
+    def __init__(self, path):
+        self.path = path
+        self.logger.info("Recording requests to %s" % path)
+        CacheStore.snapshot(snapshot_path(path))
+
+    def record(self, method, response, data=None):
+        original = response.history[0].request if response.history else response.request
+        entry = {
+            "time": time.time(),
+            "method": method,
+            "url": original.url,
+            "data": data,
+            "status": response.status_code,
+            "final_url": response.url,
+            "headers": {
+                k: v for k, v in response.headers.items() if k.lower() not in PRIVATE_HEADERS
+            },
+            "body": response.text,
+        }
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter serving a recorded archive instead of the game server
+    Responses are returned in recorded order per request, the last one is repeated when a request is made
+    more often than recorded and unknown requests get an empty 404
+    """
+    logger = logging.getLogger("Replay")
+
+    def __init__(self, path):
+        super(ReplayAdapter, self).__init__()
+        self.responses = {}
+        self.served = 0
+        self.missed = 0
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = replay_key(entry["method"], entry["url"])
+                self.responses.setdefault(key, []).append(entry)
+        self.logger.info(
+            "Loaded %d recorded requests from %s"
+            % (sum(len(x) for x in self.responses.values()), path)
+        )
+
+    def send(self, request, **kwargs):
+        key = replay_key(request.method, request.url)
+        recorded = self.responses.get(key)
+        response = requests.Response()
+        response.request = request
+        response.encoding = "utf-8"
+        if not recorded:
+            self.missed += 1
+            self.logger.debug("No recording for %s" % key)
+            response.status_code = 404
+            response.url = request.url
+            response._content = b""
+            return response
+        self.served += 1
+        entry = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+        response.status_code = entry["status"]
+        response.url = entry["final_url"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        # Body was stored decoded, drop transfer headers that no longer apply
+        response.headers.pop("content-encoding", None)
+        response.headers.pop("content-length", None)
+        response._content = entry["body"].encode("utf-8")
+        return response
+
+    def close(self):
+        pass
@@ -1,17 +1,18 @@
 import requests
 
 try:
-    from urllib.parse import urljoin, urlencode
+    from urllib.parse import urljoin, urlencode, urlparse, parse_qs
 except ImportError:
-    from urlparse import urljoin, urlencode
+    from urlparse import urljoin, urlencode, urlparse, parse_qs
 import logging
-import re
 import time
 import random
 import json
 import os
 from core.reporter import ReporterObject
+from core.extractors import ParsedPage
 from core.notifier import DiscordNotifier
+from core.replay import ReplayAdapter, SessionRecorder
 
 
 class WebWrapper:
@@ -32,9 +33,24 @@ class WebWrapper:
     discord = None
     discord_notifier = None
     proxy = {}
+    # (village_id, screen, params) -> response, valid until the next write on that village
+    response_cache = {}
+    recorder = None
+    replaying = False
+    request_count = 0
 
-    def __init__(self, url, server=None, endpoint=None, reporter_enabled=False, reporter_constr=None, discord=None, discord_endpoint=None, discord_notifier=None, discord_notifier_endpoint=None, proxy_enabled=False, proxy_endpoint=None):
+    def __init__(self, url, server=None, endpoint=None, reporter_enabled=False, reporter_constr=None, discord=None, discord_endpoint=None, discord_notifier=None, discord_notifier_endpoint=None, proxy_enabled=False, proxy_endpoint=None, record_path=None, replay_path=None):
         self.web = requests.session()
+        self.response_cache = {}
+        if record_path:
+            self.recorder = SessionRecorder(record_path)
+        if replay_path:
+            # Serve a recorded session, no network and no request delays
+            adapter = ReplayAdapter(replay_path)
+            self.web.mount("https://", adapter)
+            self.web.mount("http://", adapter)
+            self.replaying = True
+            proxy_enabled = False
         if proxy_enabled and proxy_endpoint:
             self.proxy['http'] = proxy_endpoint
             self.proxy['https'] = proxy_endpoint
@@ -57,30 +73,55 @@ class WebWrapper:
         input("If IP is correct press any key to continue...")
 
     def post_process(self, response):
-        xsrf = re.search('<meta content="(.+?)" name="csrf-token"', response.text)
-        if xsrf:
-            self.headers["x-csrf-token"] = xsrf.group(1)
+        page = ParsedPage.of(response)
+        if page.csrf_token:
+            self.headers["x-csrf-token"] = page.csrf_token
             self.logger.debug("Set CSRF token")
         elif "x-csrf-token" in self.headers:
             del self.headers["x-csrf-token"]
         self.headers["Referer"] = response.url
         self.last_response = response
-        get_h = re.search(r"&h=(\w+)", response.text)
-        if get_h:
-            self.last_h = get_h.group(1)
+        if page.h:
+            self.last_h = page.h
+
+    def clear_cache(self):
+        self.response_cache = {}
+
+    def invalidate_cache(self, village_id=None):
+        if village_id is None:
+            self.clear_cache()
+            return
+        for key in list(self.response_cache):
+            if key[0] == str(village_id):
+                del self.response_cache[key]
+
+    def invalidate_for_url(self, url):
+        # Anything that changes game state drops the cached screens of the village it touched
+        query = parse_qs(urlparse(url).query)
+        village = query.get("village", [None])[0]
+        self.invalidate_cache(village_id=village)
+
+    def is_state_changing(self, url):
+        query = parse_qs(urlparse(url).query)
+        return "action" in query or "ajaxaction" in query
 
     def get_url(self, url, headers=None):
+        if self.is_state_changing(url):
+            self.invalidate_for_url(url)
         self.headers["Origin"] = (
             self.endpoint if self.endpoint else self.auth_endpoint
         ).rstrip("/")
-        if not self.priority_mode:
+        if not self.priority_mode and not self.replaying:
             time.sleep(random.randint(int(3 * self.delay), int(7 * self.delay)))
         url = urljoin(self.endpoint if self.endpoint else self.auth_endpoint, url)
         if not headers:
             headers = self.headers
         try:
             res = self.web.get(url=url, headers=headers)
+            self.request_count += 1
             self.logger.debug("GET %s [%d]" % (url, res.status_code))
+            if self.recorder:
+                self.recorder.record("GET", res)
             self.post_process(res)
             if 'data-bot-protect="forced"' in res.text:
                 msg = "Bot protection hit! Cannot continue. Solve captcha and restart"
@@ -99,7 +140,8 @@ class WebWrapper:
             return None
 
     def post_url(self, url, data, headers=None):
-        if not self.priority_mode:
+        self.invalidate_for_url(urljoin(self.endpoint if self.endpoint else self.auth_endpoint, url))
+        if not self.priority_mode and not self.replaying:
             time.sleep(random.randint(int(3 * self.delay), int(7 * self.delay)))
         self.headers["Origin"] = (
             self.endpoint if self.endpoint else self.auth_endpoint
@@ -110,7 +152,10 @@ class WebWrapper:
             headers = self.headers
         try:
             res = self.web.post(url=url, data=data, headers=headers)
+            self.request_count += 1
             self.logger.debug("POST %s %s [%d]" % (url, enc, res.status_code))
+            if self.recorder:
+                self.recorder.record("POST", res, data=data)
             self.post_process(res)
             return res
         except Exception as e:
@@ -155,9 +200,20 @@ class WebWrapper:
             }
             json.dump(session, f)
 
-    def get_action(self, village_id, action):
+    def get_action(self, village_id, action, params={}):
+        key = (str(village_id), action, tuple(sorted(params.items())))
+        if key in self.response_cache:
+            response = self.response_cache[key]
+            self.logger.debug("GET %s (cached)" % response.url)
+            self.headers["Referer"] = response.url
+            self.last_response = response
+            return response
         url = "game.php?village=%s&screen=%s" % (village_id, action)
+        if params:
+            url = "%s&%s" % (url, urlencode(params))
         response = self.get_url(url)
+        if response is not None and response.status_code == 200:
+            self.response_cache[key] = response
         return response
 
     def get_api_data(self, village_id, action, params={}):
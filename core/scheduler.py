@@ -0,0 +1,60 @@
+import heapq
+import logging
+import time
+
+
+class VillageScheduler:
+    """
+    Min-heap of (due_time, village_id, kind) entries
+    Only the newest entry of a village is valid, older ones are skipped when popped
+    """
+    queue = []
+    due_times = {}
+    logger = logging.getLogger("Scheduler")
+
+    def __init__(self):
+        self.queue = []
+        self.due_times = {}
+
+    def schedule(self, village_id, due, kind=None):
+        self.due_times[village_id] = due
+        heapq.heappush(self.queue, (due, village_id, kind))
+        self.logger.debug("Village %s scheduled at %d (%s)" % (village_id, due, kind))
+
+    def is_scheduled(self, village_id):
+        return village_id in self.due_times
+
+    def _drop_stale(self):
+        while self.queue:
+            due, village_id, _ = self.queue[0]
+            if self.due_times.get(village_id) == due:
+                return
+            heapq.heappop(self.queue)
+
+    def pop_due(self, now=None):
+        if now is None:
+            now = time.time()
+        output = []
+        self._drop_stale()
+        while self.queue and self.queue[0][0] <= now:
+            due, village_id, kind = heapq.heappop(self.queue)
+            if self.due_times.get(village_id) != due:
+                continue
+            del self.due_times[village_id]
+            output.append((village_id, kind))
+            self._drop_stale()
+        return output
+
+    def next_due(self):
+        self._drop_stale()
+        if not self.queue:
+            return None, None, None
+        return self.queue[0]
+
+    def seconds_till_next(self, now=None):
+        if now is None:
+            now = time.time()
+        due, _, _ = self.next_due()
+        if due is None:
+            return None
+        return max(0, due - now)
@@ -1,6 +1,5 @@
 import time
-import os
-import json
+from core.cachestore import CacheStore
 from core.extractors import Extractor
 import logging
 import time
@@ -27,14 +26,23 @@ class AttackManager:
     farm_radius = 50
     farm_minpoints = 0
     farm_maxpoints = 1000
-    ignored = []
+    ignored = set()
 
     forced_peace_time = None
+    # Shared FarmPlanner, when set only the targets assigned to this village are farmed
+    planner = None
+    # Send farms through the loot assistant (am_farm) templates A and B, in one request instead of three
+    use_loot_assistant = False
+    # [(template, am_farm template id)], set up once per run
+    loot_slots = []
+    # Predicted return times of the farms sent by this village
+    returns = []
+    # World speed for the farm resource estimate
+    world_speed = 1
 
     # blocks villages which cannot be attacked at the moment (too low points, beginners protection etc..)
-    _unknown_ignored = []
+    _unknown_ignored = set()
 
-    farm_high_prio_wait = 1200
     farm_default_wait = 3600
     farm_low_prio_wait = 7200
 
@@ -43,6 +51,7 @@ class AttackManager:
         self.village_id = village_id
         self.troopmanager = troopmanager
         self.map = map
+        self.returns = []
 
     def enough_in_village(self, units):
         for u in units:
@@ -61,6 +70,20 @@ class AttackManager:
                 self.logger.warning("No troops in village at all!")
                 return False
         self.get_targets()
+        self.loot_slots = []
+        if self.use_loot_assistant:
+            self.setup_loot_assistant()
+        if self.planner:
+            self.planner.update(
+                self.village_id,
+                self.targets,
+                speed=self.farm_speed(),
+                templates=self.template,
+                max_farms=self.max_farms,
+                troops=self.troopmanager.troops,
+            )
+            self.targets = self.planner.targets_for(self.village_id, self.ready_at)
+            self.logger.info("Farm targets assigned to this village: %d" % len(self.targets))
         self.priority_targets = self.repman.priority_farms(self.targets)
         if len(self.priority_targets) > 0:
             self.logger.info(f"Found {len(self.priority_targets)} priority targets!!!")
@@ -70,7 +93,7 @@ class AttackManager:
         for target in self.priority_targets[0 : self.max_farms]:
             if type(self.template) == list:
                 f = False
-                for template in self.template:
+                for template in self.templates_for(target):
                     if template in ignored:
                         continue
                     out_res = self.send_farm(target, template)
@@ -92,7 +115,7 @@ class AttackManager:
                 continue  # Don't farm the prio again
             if type(self.template) == list:
                 f = False
-                for template in self.template:
+                for template in self.templates_for(target):
                     if template in ignored:
                         continue
                     out_res = self.send_farm(target, template)
@@ -162,6 +185,46 @@ class AttackManager:
                         # All done for some reason
                         break
 
+    def predicted_returns(self):
+        now = time.time()
+        self.returns = [x for x in self.returns if x > now]
+        return list(self.returns)
+
+    def templates_for(self, target):
+        """
+        Farm templates ordered for a target, the smallest template that can carry the predicted resources goes first
+        """
+        templates = self.template
+        if len(templates) < 2 or not self.repman:
+            return templates
+        village, distance = target
+        arrival = time.time() + self.troopmanager.travel_time(templates[0], distance)
+        predicted = self.repman.estimate_resources(
+            village["id"], at=arrival, world_speed=self.world_speed
+        )
+        if not predicted:
+            return templates
+        loot = sum(predicted.values())
+        carry = self.troopmanager.carry_capacity
+        covering = sorted([x for x in templates if carry(x) >= loot], key=carry)
+        rest = sorted([x for x in templates if carry(x) < loot], key=carry, reverse=True)
+        self.logger.debug(
+            "Predicted %d resources at %s on arrival, using %s"
+            % (loot, village["id"], str((covering + rest)[0]))
+        )
+        return covering + rest
+
+    def farm_speed(self):
+        # Minutes per field of the slowest unit in the farm templates
+        templates = self.template if type(self.template) == list else [self.template]
+        speeds = [
+            self.troopmanager.unit_speeds[unit]
+            for template in templates
+            for unit in template
+            if unit in self.troopmanager.unit_speeds
+        ]
+        return max(speeds) if speeds else 1
+
     def send_farm(self, target, template):
         target, distance = target
         missing = self.enough_in_village(template)
@@ -170,11 +233,10 @@ class AttackManager:
             if is_priority:
                 self.logger.debug("Attacking priority target!!")
                 cache_entry = AttackCache.get_cache(target["id"])
-                last_attack = datetime.fromtimestamp(cache_entry["last_attack"])
-                now = datetime.now()
-                if last_attack < now - timedelta(minutes=20):
+                returned = self.returned_at(cache_entry) if cache_entry else 0
+                if returned <= time.time():
                     self.logger.debug(
-                        f"Last attack was on {last_attack}, sending again!"
+                        f"Last farm was back at {datetime.fromtimestamp(returned)}, sending again!"
                     )
                     cached = True
                 else:
@@ -183,7 +245,9 @@ class AttackManager:
                 cached = self.can_attack(vid=target["id"], clear=False)
 
             if cached:
-                attack_result = self.attack(target["id"], troops=template)
+                attack_result = self.loot_attack(target["id"], troops=template)
+                if attack_result is None:
+                    attack_result = self.attack(target["id"], troops=template)
                 if attack_result == "forced_peace":
                     return 0
                 self.logger.info(
@@ -205,10 +269,13 @@ class AttackManager:
                         self.troopmanager.troops[u] = str(
                             int(self.troopmanager.troops[u]) - template[u]
                         )
+                    travel = self.troopmanager.travel_time(template, distance)
+                    self.returns.append(int(time.time()) + 2 * travel)
                     self.attacked(
                         target["id"],
                         scout=True,
                         safe=True,
+                        arrival=int(time.time()) + travel,
                         high_profile=cached["high_profile"]
                         if type(cached) == dict
                         else False,
@@ -221,7 +288,7 @@ class AttackManager:
                     self.logger.debug(
                         "Ignoring target %s because unable to attack" % target["id"]
                     )
-                    self._unknown_ignored.append(target["id"])
+                    self._unknown_ignored.add(target["id"])
         else:
             self.logger.debug(
                 "Not sending additional farm because not enough units: %s" % missing
@@ -236,15 +303,15 @@ class AttackManager:
             if self.village_id in self.map.villages
             else None
         )
-        for vid in self.map.villages:
-            village = self.map.villages[vid]
+        for village, distance in self.map.villages_in_radius(self.farm_radius):
+            vid = village["id"]
             if village["owner"] != "0" and vid not in self.extra_farm:
                 if vid not in self.ignored:
                     self.logger.debug(
                         "Ignoring village %s because player owned, add to additional_farms to auto attack"
                         % vid
                     )
-                    self.ignored.append(vid)
+                    self.ignored.add(vid)
                 continue
             if (
                 "bonus" in village
@@ -261,7 +328,7 @@ class AttackManager:
                             "Ignoring village %s because points %d exceeds limit %d"
                             % (vid, village["points"], self.farm_maxpoints)
                         )
-                        self.ignored.append(vid)
+                        self.ignored.add(vid)
                     continue
                 if village["points"] <= self.farm_minpoints:
                     if vid not in self.ignored:
@@ -269,7 +336,7 @@ class AttackManager:
                             "Ignoring village %s because points %d below limit %d"
                             % (vid, village["points"], self.farm_minpoints)
                         )
-                        self.ignored.append(vid)
+                        self.ignored.add(vid)
                     continue
                 if (
                     village["points"] >= my_village["points"]
@@ -280,7 +347,7 @@ class AttackManager:
                             "Ignoring village %s because of higher points %d -> %d"
                             % (vid, my_village["points"], village["points"])
                         )
-                        self.ignored.append(vid)
+                        self.ignored.add(vid)
                     continue
                 if vid in self._unknown_ignored:
                     continue
@@ -292,18 +359,9 @@ class AttackManager:
                         % vid
                     )
                     continue
-            distance = self.map.get_dist(village["location"])
-            if distance > self.farm_radius:
-                if vid not in self.ignored:
-                    self.logger.debug(
-                        "Village %s will be ignored because it is too far away: distance is %f, max is %d"
-                        % (vid, distance, self.farm_radius)
-                    )
-                    self.ignored.append(vid)
-                continue
             if vid in self.ignored:
                 self.logger.debug("Removed %s from farm ignore list" % vid)
-                self.ignored.remove(vid)
+                self.ignored.discard(vid)
 
             output.append([village, distance])
         self.logger.info(
@@ -312,7 +370,7 @@ class AttackManager:
         self.targets = sorted(output, key=lambda x: x[1])
 
     def attacked(
-        self, vid, scout=False, high_profile=False, safe=True, low_profile=False
+        self, vid, scout=False, high_profile=False, safe=True, low_profile=False, arrival=None
     ):
         cache_entry = {
             "scout": scout,
@@ -320,8 +378,12 @@ class AttackManager:
             "high_profile": high_profile,
             "low_profile": low_profile,
             "last_attack": int(time.time()),
+            # The farm is looted on arrival, waits count from there
+            "arrival": arrival if arrival else int(time.time()),
         }
         AttackCache.set_cache(vid, cache_entry)
+        if self.planner:
+            self.planner.attacked(vid, cache_entry)
 
     def scout(self, vid):
         if (
@@ -404,36 +466,36 @@ class AttackManager:
         if not cache_entry["scout"] and self.troopmanager.can_scout:
             self.scout(vid)
             return False
-        min_time = self.farm_default_wait
-        if cache_entry["high_profile"]:
-            min_time = self.farm_high_prio_wait
-        if "low_profile" in cache_entry and cache_entry["low_profile"]:
-            min_time = self.farm_low_prio_wait
-
-        if cache_entry and self.repman:
-            res_left, res = self.repman.has_resources_left(vid)
-            total_loot = 0
-            for x in res:
-                total_loot += int(res[x])
-
-            if res_left and total_loot > 100:
-                self.logger.debug(
-                    f"Draining farm of resources! Sending attack to get {res}."
-                )
-                min_time = int(self.farm_high_prio_wait / 2)
-
-            if total_loot == 0:
-                self.logger.debug(f"Farm empty! Extending farm time!")
-                min_time = int(min_time * 1.5)
-
-        if cache_entry["last_attack"] + min_time > int(time.time()):
+        ready = self.ready_at(vid, cache_entry)
+        if ready > int(time.time()):
             self.logger.debug(
-                "%s will be ignored because of previous attack (%d sec delay between attacks)"
-                % (vid, min_time)
+                "%s will be ignored because of previous attack (ready at %s)"
+                % (vid, datetime.fromtimestamp(ready))
             )
             return False
         return cache_entry
 
+    @staticmethod
+    def returned_at(cache_entry):
+        # Predicted return of the previous farm, the way back takes as long as the way there
+        arrival = cache_entry.get("arrival", cache_entry["last_attack"])
+        return arrival + (arrival - cache_entry["last_attack"])
+
+    def ready_at(self, vid, cache_entry):
+        """
+        Farms go out again as soon as the previous farm on vid is predicted back home
+        Low profile farms and farms scouted empty rest for low_loot_away_time / default_away_time after that
+        """
+        rest = 0
+        if "low_profile" in cache_entry and cache_entry["low_profile"]:
+            rest = self.farm_low_prio_wait
+        elif self.repman:
+            res_left, res = self.repman.has_resources_left(vid)
+            if res and "unknown" not in res and sum(int(x) for x in res.values()) == 0:
+                self.logger.debug(f"Farm empty! Extending farm time!")
+                rest = self.farm_default_wait
+        return self.returned_at(cache_entry) + rest
+
     def has_troops_available(self, troops):
         for t in troops:
             if (
@@ -443,6 +505,62 @@ class AttackManager:
                 return False
         return True
 
+    def setup_loot_assistant(self):
+        templates = self.template if type(self.template) == list else [self.template]
+        templates = [x for x in templates if x][0:2]
+        if not templates:
+            return
+        res = self.wrapper.get_action(
+            village_id=self.village_id, action="am_farm", params={"mode": "farm"}
+        )
+        slots = Extractor.farm_templates(res) if res else []
+        if len(slots) < len(templates):
+            self.logger.info("Loot assistant not available, sending farms from the rally point")
+            return
+        changed = {}
+        for template, slot in zip(templates, slots):
+            if slot["units"] != {u: template.get(u, 0) for u in slot["units"]}:
+                for unit in slot["units"]:
+                    changed["%s[%s]" % (unit, slot["id"])] = str(template.get(unit, 0))
+        if changed:
+            action, form = Extractor.farm_template_form(res)
+            if not action:
+                self.logger.info("Unable to update loot assistant templates, sending farms from the rally point")
+                return
+            form = dict(form)
+            form.update(changed)
+            self.wrapper.post_url(action, data=form)
+            self.logger.info("Updated loot assistant templates to %s" % str(templates))
+        self.loot_slots = [(template, slot["id"]) for template, slot in zip(templates, slots)]
+
+    def loot_attack(self, vid, troops=None):
+        """
+        Sends a farm with a loot assistant template, None means the rally point has to be used
+        """
+        if self.forced_peace_time:
+            # Arrival time is only known from the rally point confirm screen
+            return None
+        template_id = None
+        for template, slot_id in self.loot_slots:
+            if template == troops:
+                template_id = slot_id
+        if not template_id:
+            return None
+        result = self.wrapper.get_api_action(
+            village_id=self.village_id,
+            action="farm",
+            params={"screen": "am_farm", "mode": "farm", "json": "1"},
+            data={"target": vid, "template_id": template_id, "source": self.village_id},
+        )
+        self.troopmanager.totals_stale = True
+        if type(result) != dict:
+            return None
+        if "error" in result:
+            self.logger.debug("Loot assistant refused farm on %s: %s" % (vid, str(result["error"])))
+            return None
+        self.logger.info("[Attack] %s -> %s (loot assistant)" % (self.village_id, vid))
+        return result
+
     def attack(self, vid, troops=None):
         url = "game.php?village=%s&screen=place&target=%s" % (self.village_id, vid)
         pre_attack = self.wrapper.get_url(url)
@@ -498,6 +616,7 @@ class AttackManager:
             params={"screen": "place"},
             data=confirm_data,
         )
+        self.troopmanager.totals_stale = True
 
         return result
 
@@ -505,26 +624,12 @@ class AttackManager:
 class AttackCache:
     @staticmethod
     def get_cache(village_id):
-        t_path = os.path.join("cache", "attacks", village_id + ".json")
-        if os.path.exists(t_path):
-            with open(t_path, "r") as f:
-                return json.load(f)
-        return None
+        return CacheStore.get("attacks", village_id)
 
     @staticmethod
     def set_cache(village_id, entry):
-        t_path = os.path.join("cache", "attacks", village_id + ".json")
-        with open(t_path, "w") as f:
-            return json.dump(entry, f)
+        return CacheStore.set("attacks", village_id, entry)
 
     @staticmethod
     def cache_grab():
-        output = {}
-        c_path = os.path.join("cache", "attacks")
-        for existing in os.listdir(c_path):
-            if not existing.endswith(".json"):
-                continue
-            t_path = os.path.join("cache", "attacks", existing)
-            with open(t_path, "r") as f:
-                output[existing.replace(".json", "")] = json.load(f)
-        return output
+        return CacheStore.all("attacks")
@@ -0,0 +1,166 @@
+import logging
+import math
+import time
+
+from core.extractors import Extractor
+
+
+class ResourceBalancer:
+    """
+    Account wide resource transports between own villages
+    Villages holding more than they need send to villages waiting for resources, closest pairs first
+    """
+    wrapper = None
+    merchant_capacity = 1000
+    # Minutes per field of a merchant on a speed 1 world
+    merchant_speed = 6
+    world_speed = 1
+    # Smaller transports are not worth the merchants
+    min_transport = 500
+    # receiver village id -> [(arrival, {resource: amount})] of transports still on their way
+    in_transit = {}
+    logger = logging.getLogger("Balancer")
+
+    def __init__(self, wrapper=None):
+        self.wrapper = wrapper
+        self.in_transit = {}
+
+    def incoming(self, village_id, now):
+        transports = [x for x in self.in_transit.get(village_id, []) if x[0] > now]
+        self.in_transit[village_id] = transports
+        output = {"wood": 0, "stone": 0, "iron": 0}
+        for arrival, resources in transports:
+            for res, amount in resources.items():
+                output[res] += amount
+        return output
+
+    @staticmethod
+    def demand(resman, incoming):
+        # The requested amounts are shortfalls, what is on its way already covers part of them
+        output = {}
+        for res in ["wood", "stone", "iron"]:
+            missing = min(
+                resman.in_need_amount(res) - incoming.get(res, 0),
+                resman.storage - resman.actual[res],
+            )
+            if missing > 0:
+                output[res] = int(missing)
+        return output
+
+    @staticmethod
+    def surplus(resman):
+        # Same share of the storage get_plenty_off considers plenty, nothing of a resource we are short of
+        output = {}
+        for res in ["wood", "stone", "iron"]:
+            if resman.in_need_amount(res) > 0:
+                continue
+            spare = resman.actual[res] - resman.storage / resman.ratio
+            if spare > 0:
+                output[res] = int(spare)
+        return output
+
+    def plan(self, state, merchants):
+        """
+        Transports as (sender, receiver, {resource: amount}, distance)
+        The closest pair of villages is served first, a transport uses what is left of the sender's
+        merchants and is skipped when it would carry less than min_transport
+        state: village_id -> {"location": [x, y], "surplus": {...}, "demand": {...}}
+        """
+        surplus = {vid: dict(entry["surplus"]) for vid, entry in state.items()}
+        demand = {vid: dict(entry["demand"]) for vid, entry in state.items()}
+        capacity = {
+            vid: merchants.get(vid, 0) * self.merchant_capacity for vid in state
+        }
+        pairs = []
+        for sender in state:
+            if not surplus[sender] or not capacity[sender]:
+                continue
+            for receiver in state:
+                if receiver == sender or not demand[receiver]:
+                    continue
+                distance = math.hypot(
+                    state[sender]["location"][0] - state[receiver]["location"][0],
+                    state[sender]["location"][1] - state[receiver]["location"][1],
+                )
+                pairs.append((distance, sender, receiver))
+        pairs.sort(key=lambda x: x[0])
+
+        output = []
+        for distance, sender, receiver in pairs:
+            left = capacity[sender]
+            resources = {}
+            for res in ["wood", "stone", "iron"]:
+                amount = min(
+                    surplus[sender].get(res, 0), demand[receiver].get(res, 0), left
+                )
+                if amount > 0:
+                    resources[res] = amount
+                    left -= amount
+            if sum(resources.values()) < self.min_transport:
+                continue
+            for res, amount in resources.items():
+                surplus[sender][res] -= amount
+                demand[receiver][res] -= amount
+            capacity[sender] = left
+            output.append((sender, receiver, resources, distance))
+        return output
+
+    def send(self, village_id, location, resources):
+        data = dict(resources)
+        data.update({"x": location[0], "y": location[1], "target_type": "coord", "input": ""})
+        conf = self.wrapper.post_url(
+            "game.php?village=%s&screen=market&try=confirm_send" % village_id, data=data
+        )
+        if not conf or '<div class="error_box">' in conf.text:
+            return False
+        confirm_data = {}
+        for k, v in Extractor.attack_form(conf):
+            confirm_data[k] = v
+        confirm_data["h"] = self.wrapper.last_h
+        result = self.wrapper.post_url(
+            "game.php?village=%s&screen=market&action=send" % village_id,
+            data=confirm_data,
+        )
+        return result is not None
+
+    def run(self, villages):
+        now = time.time()
+        state = {}
+        by_id = {}
+        for vil in villages:
+            if not vil.resman or not vil.resman.actual or not vil.game_data:
+                continue
+            has_market = vil.builder and vil.builder.get_level("market")
+            state[vil.village_id] = {
+                "location": [vil.game_data["village"]["x"], vil.game_data["village"]["y"]],
+                "surplus": self.surplus(vil.resman) if has_market else {},
+                "demand": self.demand(vil.resman, self.incoming(vil.village_id, now)),
+            }
+            by_id[vil.village_id] = vil
+        if not any(entry["demand"] for entry in state.values()):
+            return []
+
+        merchants = {}
+        for vid, entry in state.items():
+            if entry["surplus"]:
+                res = self.wrapper.get_url(
+                    "game.php?village=%s&screen=market&mode=send" % vid
+                )
+                merchants[vid] = Extractor.merchants_available(res) if res else 0
+
+        sent = []
+        for sender, receiver, resources, distance in self.plan(state, merchants):
+            if not self.send(sender, state[receiver]["location"], resources):
+                self.logger.warning(
+                    "Unable to send %s from %s to %s" % (resources, sender, receiver)
+                )
+                continue
+            arrival = now + distance * self.merchant_speed * 60 / self.world_speed
+            self.in_transit.setdefault(receiver, []).append((arrival, resources))
+            for res, amount in resources.items():
+                by_id[sender].resman.actual[res] -= amount
+            self.logger.info(
+                "Sent %s from %s to %s (%.1f fields)" % (resources, sender, receiver, distance)
+            )
+            sent.append((sender, receiver, resources))
+        return sent
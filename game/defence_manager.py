@@ -13,6 +13,8 @@ class DefenceManager:
     under_attack = False
     auto_evacuate = False
     attacks = []
+    # Arrival times from the account wide incomings poll
+    arrivals = []
 
     # list of village_id, attack_state
     my_other_villages = {}
@@ -69,7 +71,7 @@ class DefenceManager:
         ok = True
         self.manage_flags()
         self.runs += 1
-        if "command/attack.png" in main:
+        if "command/attack.png" in main or self.arrivals:
             self.under_attack = True
             ok = False
             self.flag_logic(self.set_flag_under_attack)
@@ -272,5 +274,6 @@ class DefenceManager:
             params={"screen": "place"},
             data=confirm_data,
         )
+        self.units.totals_stale = True
 
         return result
@@ -0,0 +1,139 @@
+import logging
+import math
+import time
+
+from game.attack import AttackCache
+
+
+class FarmPlanner:
+    """
+    Account wide farm assignment shared by all own villages
+    Every farm target goes to the due village that reaches it fastest and still has farms to send,
+    targets that are not ready for the next farm are left out so no two villages farm the same village back to back
+    """
+    # village_id -> {"targets": [[village, distance]], "speed": minutes per field, "capacity": farms,
+    # "templates": farm templates, "max_farms": farms per run}
+    villages = {}
+    assignment = {}
+    # Villages due this cycle and the ones of those that already farmed, see new_cycle()
+    due = set()
+    ran = set()
+    # Attack cache read once per cycle and the targets that can not be farmed yet
+    attacks = None
+    recent = None
+    logger = logging.getLogger("FarmPlanner")
+
+    def __init__(self):
+        self.villages = {}
+        self.assignment = {}
+        self.due = set()
+        self.ran = set()
+
+    def new_cycle(self, due, troops=None):
+        """
+        Plans only for the villages that run this cycle, their capacity is refreshed from the units overview
+        """
+        self.due = set(due)
+        self.ran = set()
+        self.attacks = None
+        self.recent = None
+        for village_id in self.due:
+            entry = self.villages.get(village_id)
+            if entry and troops and village_id in troops:
+                entry["capacity"] = self.capacity(
+                    troops[village_id]["home"], entry["templates"], entry["max_farms"]
+                )
+
+    def update(self, village_id, targets, speed, templates, max_farms, troops):
+        self.villages[village_id] = {
+            "targets": targets,
+            "speed": speed,
+            "capacity": self.capacity(troops, templates, max_farms),
+            "templates": templates,
+            "max_farms": max_farms,
+        }
+
+    def done(self, village_id):
+        # The village farmed its slice, targets it did not send to are free for the villages after it
+        self.ran.add(village_id)
+
+    def attacked(self, vid, entry):
+        if self.attacks is not None:
+            self.attacks[vid] = entry
+        if self.recent is not None:
+            self.recent.add(vid)
+
+    def recently_attacked(self, now, ready_at):
+        """
+        Targets that can not be farmed yet, ready_at(vid, entry) gives the time a target can be farmed again
+        """
+        if self.attacks is None:
+            self.attacks = AttackCache.cache_grab()
+        if self.recent is None:
+            self.recent = set()
+            for vid, entry in self.attacks.items():
+                if not entry.get("last_attack"):
+                    continue
+                if ready_at(vid, entry) > now:
+                    self.recent.add(vid)
+        return self.recent
+
+    def assign(self, village_id, ready_at):
+        """
+        Greedy assignment over (village, target) pairs ordered by travel time, which keeps the total
+        travel time low without solving the full transport problem
+        """
+        now = time.time()
+        recent = self.recently_attacked(now, ready_at)
+        left = {}
+        pairs = []
+        for vid, entry in self.villages.items():
+            if vid != village_id and (vid not in self.due or vid in self.ran):
+                continue
+            if entry["capacity"] <= 0:
+                continue
+            left[vid] = entry["capacity"]
+            for target, distance in entry["targets"]:
+                if target["id"] in recent:
+                    continue
+                pairs.append((distance * entry["speed"], vid, target, distance))
+        pairs.sort(key=lambda x: x[0])
+
+        assigned = set()
+        output = {vid: [] for vid in left}
+        total = 0
+        for travel, vid, target, distance in pairs:
+            if target["id"] in assigned or not left[vid]:
+                continue
+            assigned.add(target["id"])
+            left[vid] -= 1
+            output[vid].append([target, distance])
+            total += travel
+        self.assignment = output
+        self.logger.debug(
+            "Assigned %d farm targets to %d villages (%d minutes travel in total)"
+            % (len(assigned), len(output), total)
+        )
+        return output
+
+    def targets_for(self, village_id, ready_at):
+        return self.assign(village_id, ready_at).get(village_id, [])
+
+    @staticmethod
+    def capacity(troops, templates, max_farms):
+        # Farms the village can send with every template on its own, the templates share units so this is an upper bound
+        if type(templates) != list:
+            templates = [templates]
+        farms = 0
+        for template in templates:
+            if not template:
+                continue
+            farms += min(
+                [
+                    math.floor(int(troops.get(unit, 0)) / amount)
+                    for unit, amount in template.items()
+                    if amount
+                ]
+                or [0]
+            )
+        return min(farms, max_farms)
@@ -0,0 +1,58 @@
+import logging
+import time
+
+from core.extractors import Extractor
+
+
+class IncomingsMonitor:
+    """
+    Account wide incoming attack poll using overview_villages&mode=incomings
+    Keeps the arrival times of incoming attacks per target village
+    """
+    wrapper = None
+    interval = 120
+    last_poll = 0
+    # target village id -> sorted arrival timestamps
+    arrivals = {}
+    logger = logging.getLogger("Incomings")
+
+    def __init__(self, wrapper=None, interval=120):
+        self.wrapper = wrapper
+        self.interval = interval
+        self.arrivals = {}
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.last_poll >= self.interval
+
+    def poll(self, force=False):
+        """
+        Refreshes the incoming attacks, returns the villages that got new attacks since the last poll
+        """
+        now = time.time()
+        if not force and not self.due(now):
+            return []
+        self.last_poll = now
+        res = self.wrapper.get_url(
+            "game.php?screen=overview_villages&mode=incomings&subtype=attacks&page=-1"
+        )
+        if not res:
+            return []
+        arrivals = Extractor.incomings_overview(res)
+        new_targets = []
+        for vid, times in arrivals.items():
+            known = set(self.arrivals.get(vid, []))
+            if any(x not in known for x in times):
+                new_targets.append(vid)
+        self.arrivals = arrivals
+        if new_targets:
+            self.logger.warning(
+                "New incoming attacks on villages: %s" % ", ".join(new_targets)
+            )
+        return new_targets
+
+    def upcoming(self, village_id):
+        now = time.time()
+        return [x for x in self.arrivals.get(str(village_id), []) if x > now]
+
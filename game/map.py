@@ -1,101 +1,177 @@
+import logging
 import math
-from core.extractors import Extractor
-import os
-import json
+from core.cachestore import CacheStore
+from core.extractors import Extractor, json_loads
 import time
-import glob
 
 
-class Map:
-    wrapper = None
-    village_id = None
-    map_data = []
+class WorldMap:
+    """
+    Account wide map shared by all own villages
+    Tracks when each 20x20 map sector was loaded so only stale or missing sectors get fetched
+    """
     villages = {}
-    my_location = None
     map_pos = {}
-    last_fetch = 0
+    # (sector_x, sector_y) -> time loaded
+    sectors = {}
+    sector_size = 20
     fetch_delay = 8
+    # (x // grid_size, y // grid_size) -> village ids, rebuilt on every map refresh
+    grid = {}
+    grid_size = 10
+    # In-memory copy of the villages cache, loaded once and written back in batches
+    cached = None
+    dirty = {}
+    logger = logging.getLogger("WorldMap")
 
-    def __init__(self, wrapper=None, village_id=None):
-        self.wrapper = wrapper
-        self.village_id = village_id
+    def __init__(self):
+        self.villages = {}
+        self.map_pos = {}
+        self.sectors = {}
+        self.grid = {}
+        self.cached = None
+        self.dirty = {}
 
-    def get_map(self):
-        if self.last_fetch + (self.fetch_delay * 3600) > time.time():
-            return
-        self.last_fetch = time.time()
-        res = self.wrapper.get_action(village_id=self.village_id, action="map")
-        game_state = Extractor.game_state(res)
-        self.map_data = Extractor.map_data(res)
-        if self.map_data:
-            for tile in self.map_data:
-                data = tile["data"]
-                x = int(data["x"])
-                y = int(data["y"])
-                vdata = data["villages"]
-                # Fix broken parsing                 
-                if type(vdata) is dict:
-                    cdata = [{}] * 20
-                    for k, v in vdata.items():
-                        if type(v) is not dict:
-                            cdata[int(k)] = {0: item[0:] for item in v}
-                        else:
-                            cdata[int(k)] = v
-                    vdata = cdata
-                for lon, val in enumerate(vdata):
-                    if not val:
-                        continue
-                    # Force dict type to iterate properly
-                    if type(val) != dict:
-                        val = {i: val[i] for i in range(0, len(val))}
-                    for lat, entry in val.items():
-                        if not lat:
-                            continue
-                        coords = [x + int(lon), y + int(lat)]
-                        if entry[0] == str(self.village_id):
-                            self.my_location = coords
-
-                        self.build_cache_entry(location=coords, entry=entry)
-                if not self.my_location:
-                    self.my_location = [
-                        game_state["village"]["x"],
-                        game_state["village"]["y"],
-                    ]
-        if not self.map_data or not self.villages:
-            return self.get_map_old(game_state=game_state)
-        return True
+    def load_cache(self):
+        if self.cached is None:
+            self.cached = {entry["id"]: entry for entry in MapCache.get_all_cache()}
+            self.logger.debug("Loaded %d villages from map cache" % len(self.cached))
+        return self.cached
 
-    def get_map_old(self, game_state):
-        if self.map_data:
-            for tile in self.map_data:
-                data = tile["data"]
-                x = int(data["x"])
-                y = int(data["y"])
-                vdata = data["villages"]
-                for lon, lon_val in enumerate(vdata):
-                    try:
-                        for lat in vdata[lon]:
-                            coords = [x + int(lon), y + int(lat)]
-                            entry = vdata[lon][lat]
-                            if entry[0] == str(self.village_id):
-                                self.my_location = coords
-
-                            self.build_cache_entry(location=coords, entry=entry)
-                    except:
-                        raise
-            if not self.my_location:
-                self.my_location = [
-                    game_state["village"]["x"],
-                    game_state["village"]["y"],
-                ]
-        if not self.map_data or not self.villages:
-            print(
-                "Error reading map state for village %s, farming might not work properly"
-                % self.village_id
-            )
+    def cache_entry(self, vid):
+        return self.load_cache().get(vid)
+
+    def flush(self):
+        if not self.dirty:
+            return 0
+        changed = len(self.dirty)
+        MapCache.set_many(self.dirty)
+        self.dirty = {}
+        self.logger.debug("Wrote %d changed villages to map cache" % changed)
+        return changed
+
+    def sector_of(self, location):
+        return (
+            location[0] - location[0] % self.sector_size,
+            location[1] - location[1] % self.sector_size,
+        )
+
+    def stale_sectors(self, location, radius):
+        output = []
+        min_x, min_y = self.sector_of([location[0] - radius, location[1] - radius])
+        max_x, max_y = self.sector_of([location[0] + radius, location[1] + radius])
+        expired = time.time() - self.fetch_delay * 3600
+        for sector_x in range(min_x, max_x + 1, self.sector_size):
+            for sector_y in range(min_y, max_y + 1, self.sector_size):
+                if self.sectors.get((sector_x, sector_y), 0) < expired:
+                    output.append((sector_x, sector_y))
+        return output
+
+    def fetch_sectors(self, wrapper, sectors):
+        # The map screen requests extra sectors as map.php?v=2&e=<ts>&<x>_<y>=1&...
+        now = time.time()
+        query = "&".join(["%d_%d=1" % sector for sector in sectors])
+        res = wrapper.get_url("map.php?v=2&e=%d&%s" % (int(now * 1000), query))
+        for sector in sectors:
+            # Mark as loaded even if the request failed, it will be retried after fetch_delay
+            self.sectors[sector] = now
+        if res is None:
             return False
+        try:
+            tiles = json_loads(res.content)
+        except ValueError:
+            self.logger.warning("Unable to read %d map sectors" % len(sectors))
+            return False
+        self.load_tiles(tiles)
+        self.logger.debug("Loaded %d map sectors" % len(sectors))
         return True
 
+    def load_tiles(self, tiles, village_id=None):
+        own_location = None
+        for tile in tiles:
+            data = tile["data"]
+            x = int(data["x"])
+            y = int(data["y"])
+            self.sectors[self.sector_of([x, y])] = time.time()
+            vdata = data["villages"]
+            # Fix broken parsing
+            if type(vdata) is dict:
+                cdata = [{}] * 20
+                for k, v in vdata.items():
+                    if type(v) is not dict:
+                        cdata[int(k)] = {0: item[0:] for item in v}
+                    else:
+                        cdata[int(k)] = v
+                vdata = cdata
+            for lon, val in enumerate(vdata):
+                if not val:
+                    continue
+                # Force dict type to iterate properly
+                if type(val) != dict:
+                    val = {i: val[i] for i in range(0, len(val))}
+                for lat, entry in val.items():
+                    if not lat:
+                        continue
+                    coords = [x + int(lon), y + int(lat)]
+                    if village_id and entry[0] == str(village_id):
+                        own_location = coords
+
+                    self.build_cache_entry(location=coords, entry=entry)
+        self.build_grid()
+        self.flush()
+        return own_location
+
+    def load_tiles_old(self, tiles, village_id=None):
+        own_location = None
+        for tile in tiles:
+            data = tile["data"]
+            x = int(data["x"])
+            y = int(data["y"])
+            self.sectors[self.sector_of([x, y])] = time.time()
+            vdata = data["villages"]
+            for lon, lon_val in enumerate(vdata):
+                for lat in vdata[lon]:
+                    coords = [x + int(lon), y + int(lat)]
+                    entry = vdata[lon][lat]
+                    if village_id and entry[0] == str(village_id):
+                        own_location = coords
+
+                    self.build_cache_entry(location=coords, entry=entry)
+        self.build_grid()
+        self.flush()
+        return own_location
+
+    def build_grid(self):
+        grid = {}
+        for vid, village in self.villages.items():
+            x, y = village["location"]
+            grid.setdefault((x // self.grid_size, y // self.grid_size), []).append(vid)
+        self.grid = grid
+
+    def villages_in_radius(self, location, radius):
+        """
+        Villages within radius fields of location as [village, distance]
+        Only the grid cells overlapping the radius are visited
+        """
+        if not self.grid and self.villages:
+            self.build_grid()
+        output = []
+        min_x = int((location[0] - radius) // self.grid_size)
+        max_x = int((location[0] + radius) // self.grid_size)
+        min_y = int((location[1] - radius) // self.grid_size)
+        max_y = int((location[1] + radius) // self.grid_size)
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                for vid in self.grid.get((cell_x, cell_y), []):
+                    village = self.villages[vid]
+                    distance = math.hypot(
+                        location[0] - village["location"][0],
+                        location[1] - village["location"][1],
+                    )
+                    if distance <= radius:
+                        output.append([village, distance])
+        return output
+
     def build_cache_entry(self, location, entry):
         vid = entry[0]
         name = entry[2]
@@ -117,46 +193,97 @@ class Map:
             "resources": {},
         }
         self.map_pos[vid] = location
-        cached = self.in_cache(vid)
-        if not cached:
-            MapCache.set_cache(village_id=vid, entry=structure)
-        if cached and cached != structure:
-            MapCache.set_cache(village_id=vid, entry=structure)
+        cached = self.cache_entry(vid)
+        if cached != structure:
+            self.cached[vid] = structure
+            self.dirty[vid] = structure
         self.villages[vid] = structure
 
+
+class Map:
+    """
+    Map as seen from one own village, the villages themselves live in the shared WorldMap
+    """
+    wrapper = None
+    village_id = None
+    world = None
+    my_location = None
+    radius = 50
+
+    def __init__(self, wrapper=None, village_id=None, world=None):
+        self.wrapper = wrapper
+        self.village_id = village_id
+        self.world = world if world else WorldMap()
+
+    @property
+    def villages(self):
+        return self.world.villages
+
+    @property
+    def map_pos(self):
+        return self.world.map_pos
+
+    def get_map(self):
+        if self.my_location:
+            stale = self.world.stale_sectors(self.my_location, self.radius)
+            if not stale:
+                return True
+            return self.world.fetch_sectors(self.wrapper, stale)
+
+        # First run for this village: the map screen gives our location and the sectors around it
+        res = self.wrapper.get_action(village_id=self.village_id, action="map")
+        game_state = Extractor.game_state(res)
+        map_data = Extractor.map_data(res)
+        if map_data:
+            self.my_location = self.world.load_tiles(map_data, village_id=self.village_id)
+            if not self.villages:
+                self.my_location = self.world.load_tiles_old(
+                    map_data, village_id=self.village_id
+                )
+            if not self.my_location:
+                self.my_location = [
+                    game_state["village"]["x"],
+                    game_state["village"]["y"],
+                ]
+        if not map_data or not self.villages:
+            print(
+                "Error reading map state for village %s, farming might not work properly"
+                % self.village_id
+            )
+            return False
+        stale = self.world.stale_sectors(self.my_location, self.radius)
+        if stale:
+            self.world.fetch_sectors(self.wrapper, stale)
+        return True
+
+    def villages_in_radius(self, radius, location=None):
+        if not location:
+            location = self.my_location
+        return self.world.villages_in_radius(location, radius)
+
     def in_cache(self, vid):
-        entry = MapCache.get_cache(village_id=vid)
-        return entry
+        return self.world.cache_entry(vid)
 
-    def get_dist(self, ext_loc):
-        distance = math.sqrt(
-            ((self.my_location[0] - ext_loc[0]) ** 2)
-            + ((self.my_location[1] - ext_loc[1]) ** 2)
-        )
+    def get_dist(self, ext_loc, location=None):
+        if not location:
+            location = self.my_location
+        distance = math.hypot(location[0] - ext_loc[0], location[1] - ext_loc[1])
         return distance
 
 
 class MapCache:
     @staticmethod
     def get_cache(village_id):
-        t_path = os.path.join("cache", "villages", village_id + ".json")
-        if os.path.exists(t_path):
-            with open(t_path, "r") as f:
-                return json.load(f)
-        return None
+        return CacheStore.get("villages", village_id)
 
     @staticmethod
     def set_cache(village_id, entry):
-        t_path = os.path.join("cache", "villages", village_id + ".json")
-        with open(t_path, "w") as f:
-            return f.write(json.dumps(entry))
+        return CacheStore.set("villages", village_id, entry)
 
     @staticmethod
-    def get_all_cache():
-        all_villages = []
-        # Load all villages from cache!
-        for t_path in glob.iglob("cache/villages/*.json"):
-            with open(t_path, "r") as f:
-                all_villages.append(json.load(f))
+    def set_many(entries):
+        return CacheStore.set_many("villages", entries)
 
-        return all_villages
+    @staticmethod
+    def get_all_cache():
+        return list(CacheStore.all("villages").values())
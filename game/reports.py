@@ -1,9 +1,12 @@
-import os
-import json
+import bisect
+import concurrent.futures
 import re
 import logging
+import time
 
-from core.extractors import Extractor
+from core.cachestore import CacheStore
+from core.extractors import Extractor, json_loads
+from game.resources import ResourceManager
 from datetime import datetime
 
 
@@ -15,24 +18,56 @@ class ReportManager:
     trade_got_accepted = False
 
     last_reports = {}
+    # dest village -> report ids in arrival order
+    reports_by_dest = {}
+    # dest village -> [(when, report_id)] sorted by when
+    timeline_by_dest = {}
+    # Highest report id processed, the report list is read until the first id at or below it
+    high_water = 0
+    max_pages = 20
+    # Reports are read once per account per cycle, the main loop resets this with new_cycle()
+    cycle_done = False
+    # Reports without an attack result icon (market, support) are only opened when trades are watched
+    read_trades = False
+    # Reports are parsed and cached in these threads while the main thread waits for the next request
+    workers = 2
+    executor = None
 
     def __init__(self, wrapper=None, village_id=None):
         self.wrapper = wrapper
         self.village_id = village_id
-    def last_report_for(self, vid):
-            possible_reports = []
-            for repid in self.last_reports:
-                entry = self.last_reports[repid]
-                if vid == entry["dest"] and "when" in entry["extra"]:
-                    possible_reports.append(entry)
-            if len(possible_reports) == 0:
-                return None
 
-            def highest_when(attack):
-                return datetime.fromtimestamp(int(attack["extra"]["when"]))
+    def load_cache(self):
+        self.last_reports = {}
+        self.reports_by_dest = {}
+        self.timeline_by_dest = {}
+        for report_id, entry in ReportCache.cache_grab().items():
+            self.add_report(report_id, entry)
+
+    def add_report(self, report_id, entry):
+        if report_id in self.last_reports:
+            self.remove_report(report_id)
+        self.last_reports[report_id] = entry
+        dest = entry["dest"]
+        self.reports_by_dest.setdefault(dest, []).append(report_id)
+        if "when" in entry["extra"]:
+            bisect.insort(
+                self.timeline_by_dest.setdefault(dest, []),
+                (int(entry["extra"]["when"]), report_id),
+            )
 
-            # self.logger.debug(f"Reports: {possible_reports}")
-            return max(possible_reports, key=highest_when)
+    def remove_report(self, report_id):
+        entry = self.last_reports.pop(report_id)
+        dest = entry["dest"]
+        self.reports_by_dest[dest].remove(report_id)
+        if "when" in entry["extra"]:
+            self.timeline_by_dest[dest].remove((int(entry["extra"]["when"]), report_id))
+
+    def last_report_for(self, vid):
+        timeline = self.timeline_by_dest.get(vid)
+        if not timeline:
+            return None
+        return self.last_reports[timeline[-1][1]]
 
     def priority_farms(self, farms):
         priority = []
@@ -56,21 +91,73 @@ class ReportManager:
                     priority.append(farm)
 
         return priority
+
+    @staticmethod
+    def storage_capacity(level):
+        return 1000 * 1.2294934 ** (max(level, 1) - 1)
+
+    @staticmethod
+    def hidden_capacity(level):
+        if not level:
+            return 0
+        return 150 * (4 / 3) ** (level - 1)
+
+    def estimate_resources(self, vid, at=None, world_speed=1):
+        """
+        Predicted lootable resources of a farm at a given time
+        Starts at the last scout report with building levels, adds the mine production since then and
+        subtracts the loot of every attack after it
+        """
+        if not at:
+            at = time.time()
+        timeline = self.timeline_by_dest.get(vid, [])
+        scout = None
+        for index in range(len(timeline) - 1, -1, -1):
+            when, repid = timeline[index]
+            extra = self.last_reports[repid]["extra"]
+            if when and "buildings" in extra and extra.get("resources"):
+                scout = index
+                break
+        if scout is None:
+            return None
+
+        last, repid = timeline[scout]
+        extra = self.last_reports[repid]["extra"]
+        buildings = extra["buildings"]
+        storage = self.storage_capacity(buildings.get("storage", 1))
+        hidden = self.hidden_capacity(buildings.get("hide", 0))
+        resources = {}
+        production = {}
+        for res in ["wood", "stone", "iron"]:
+            resources[res] = int(extra["resources"].get(res, 0))
+            production[res] = ResourceManager.mine_production(
+                buildings.get(res, 0), world_speed
+            )
+
+        for when, repid in timeline[scout + 1:]:
+            if not when or when < last:
+                continue
+            loot = self.last_reports[repid]["extra"].get("loot", {})
+            for res in resources:
+                grown = resources[res] + production[res] * (when - last) / 3600
+                resources[res] = max(0, min(storage, grown) - int(loot.get(res, 0)))
+            last = when
+
+        hours = max(0, at - last) / 3600
+        return {
+            res: max(0, int(min(storage, resources[res] + production[res] * hours) - hidden))
+            for res in resources
+        }
+
     def has_resources_left(self, vid):
-        possible_reports = []
-        for repid in self.last_reports:
-            entry = self.last_reports[repid]
-            if vid == entry["dest"] and entry["extra"].get("when", None):
-                possible_reports.append(entry)
-        # self.logger.debug(f"Considered {len(possible_reports)} reports")
-        if len(possible_reports) == 0:
+        entry = None
+        for when, repid in reversed(self.timeline_by_dest.get(vid, [])):
+            if when:
+                entry = self.last_reports[repid]
+                break
+        if not entry:
             return False, {}
 
-        def highest_when(attack):
-            return datetime.fromtimestamp(int(attack["extra"]["when"]))
-
-        # self.logger.debug(f"Reports: {possible_reports}")
-        entry = max(possible_reports, key=highest_when)
         if "spy" in entry["extra"]["units_sent"]:
             if "resources" in entry["extra"] and entry["extra"]["resources"] != {}:
                 return True, entry["extra"]["resources"]
@@ -114,7 +201,7 @@ class ReportManager:
         return total_carry == total_loot
 
     def safe_to_engage(self, vid):
-        for repid in self.last_reports:
+        for repid in self.reports_by_dest.get(vid, []):
             entry = self.last_reports[repid]
             if vid == entry["dest"]:
                 if entry["type"] == "attack" and entry["losses"] == {}:
@@ -148,58 +235,98 @@ class ReportManager:
                     return 0  # Disengage if anything was lost!
         return -1
 
-    def read(self, page=0, full_run=False):
+    def new_cycle(self):
+        self.cycle_done = False
+
+    def read(self, full_run=False):
         if not self.logger:
             self.logger = logging.getLogger("Reports")
+        if self.cycle_done:
+            return
+        self.cycle_done = True
         self.trade_got_accepted = False
 
         if len(self.last_reports) == 0:
             self.logger.info("First run, re-reading cache entries")
-            self.last_reports = ReportCache.cache_grab()
+            self.load_cache()
             self.logger.info("Got %d reports from cache" % len(self.last_reports))
-        url = "game.php?village=%s&screen=report&mode=all&from=%d" % (
-            self.village_id,
-            page * 12,
-        )
-        result = self.wrapper.get_url(url)
-        self.game_state = Extractor.game_state(result)
+        if not self.high_water:
+            stored = CacheStore.get_meta("reports_high_water")
+            self.high_water = int(stored) if stored else 0
+        # A full run reads every page until max_pages, only skipping reports it already has
+        high_water = 0 if full_run else self.high_water
+        newest = self.high_water
         new = 0
-
-        ids = Extractor.report_table(result)
-        for report_id in ids:
-            if report_id in self.last_reports:
-                continue
-            new += 1
-            url = "game.php?village=%s&screen=report&mode=all&group_id=0&view=%s" % (
+        skipped = 0
+        if not self.executor:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="Reports"
+            )
+        parsing = []
+        for page in range(self.max_pages):
+            url = "game.php?village=%s&screen=report&mode=all&from=%d" % (
                 self.village_id,
-                report_id,
+                page * 12,
             )
-            data = self.wrapper.get_url(url)
-
-            get_type = re.search(r'class="report_(\w+)', data.text)
-            if get_type:
-                report_type = get_type.group(1)
-                if report_type == "ReportAttack":
-                    self.attack_report(data.text, report_id)
+            result = self.wrapper.get_url(url)
+            self.game_state = Extractor.game_state(result)
+            rows = Extractor.report_rows(result)
+            reached = False
+            for report_id, icons in rows:
+                if int(report_id) <= high_water:
+                    reached = True
+                    break
+                if report_id in self.last_reports:
+                    if not full_run:
+                        reached = True
+                        break
                     continue
-                else:
-                    if report_type == "ReportAccept":
-                        players = re.findall(r'data-player="(\d+)"', data.text)
-                        seller = players[0]
-                        buyer = players[1]
-                        if buyer == self.game_state["player"]["id"]:
-                            self.logger.debug("We bought something on the market")
-                        elif seller == self.game_state["player"]["id"]:
-                            self.logger.debug("We sold something on the market")
-                            self.trade_got_accepted = True
-                    res = self.put(report_id, report_type=report_type)
-                    self.last_reports[report_id] = res
-        if new == 12 or full_run and page < 20:
-            page += 1
-            self.logger.debug(
-                "%d new reports where added, also checking page %d" % (new, page)
-            )
-            return self.read(page, full_run=full_run)
+                newest = max(newest, int(report_id))
+                if not self.read_trades and not any(x.startswith("dots/") for x in icons):
+                    skipped += 1
+                    continue
+                new += 1
+                parsing.append(self.read_report(report_id))
+            if reached or len(rows) < 12:
+                break
+        # Index on this thread only, the parsing threads just build and cache the entries
+        for future in parsing:
+            report_id, entry = future.result()
+            if entry:
+                self.add_report(report_id, entry)
+        if newest > self.high_water:
+            self.high_water = newest
+            CacheStore.set_meta("reports_high_water", newest)
+        self.logger.debug(
+            "%d new reports read, %d without attack results skipped (up to %d)"
+            % (new, skipped, self.high_water)
+        )
+
+    def read_report(self, report_id):
+        url = "game.php?village=%s&screen=report&mode=all&group_id=0&view=%s" % (
+            self.village_id,
+            report_id,
+        )
+        data = self.wrapper.get_url(url)
+        return self.executor.submit(self.parse_report, report_id, data.text)
+
+    def parse_report(self, report_id, report):
+        get_type = re.search(r'class="report_(\w+)', report)
+        if not get_type:
+            return report_id, None
+        report_type = get_type.group(1)
+        if report_type == "ReportAttack":
+            return report_id, self.attack_report(report, report_id)
+        if report_type == "ReportAccept":
+            players = re.findall(r'data-player="(\d+)"', report)
+            seller = players[0]
+            buyer = players[1]
+            if buyer == self.game_state["player"]["id"]:
+                self.logger.debug("We bought something on the market")
+            elif seller == self.game_state["player"]["id"]:
+                self.logger.debug("We sold something on the market")
+                self.trade_got_accepted = True
+        return report_id, self.put(report_id, report_type=report_type)
 
     def re_unit(self, inp):
         output = {}
@@ -307,7 +434,7 @@ class ReportManager:
             )
             if scout_buildings:
                 raw = scout_buildings.group(1).replace("&quot;", '"')
-                extra["buildings"] = self.re_building(json.loads(raw))
+                extra["buildings"] = self.re_building(json_loads(raw))
             found_res = {}
             for loot_entry in re.findall(
                 r'<span class="icon header (wood|stone|iron)".+?</span>(\d+)',
@@ -323,11 +450,9 @@ class ReportManager:
                 extra["units_away"] = data_away
 
         attack_type = "scout" if scout_results and not results else "attack"
-        res = self.put(
+        return self.put(
             report_id, attack_type, from_village, to_village, data=extra, losses=losses
         )
-        self.last_reports[report_id] = res
-        return True
 
     def put(
         self,
@@ -345,7 +470,12 @@ class ReportManager:
             "losses": losses,
             "extra": data,
         }
-        ReportCache.set_cache(report_id, output)
+        # Reports are stored from the parsing threads, a report stored twice is only counted once
+        with CacheStore.lock:
+            known = ReportCache.get_cache(report_id) is not None
+            ReportCache.set_cache(report_id, output)
+            if not known:
+                FarmStats.ingest(output)
         self.logger.info(
             "Processed %s report with id %s" % (report_type, str(report_id))
         )
@@ -355,26 +485,93 @@ class ReportManager:
 class ReportCache:
     @staticmethod
     def get_cache(report_id):
-        t_path = os.path.join("cache", "reports", report_id + ".json")
-        if os.path.exists(t_path):
-            with open(t_path, "r") as f:
-                return json.load(f)
-        return None
+        return CacheStore.get("reports", report_id)
 
     @staticmethod
     def set_cache(report_id, entry):
-        t_path = os.path.join("cache", "reports", report_id + ".json")
-        with open(t_path, "w") as f:
-            return json.dump(entry, f)
+        return CacheStore.set("reports", report_id, entry)
 
     @staticmethod
     def cache_grab():
+        return CacheStore.all("reports")
+
+
+class FarmStats:
+    """
+    Per farm totals of the attack and scout reports, updated as every report is stored
+    so the farm manager does not have to walk all reports for each farm
+    """
+    # Stored totals of another version are built again from the reports
+    version = 2
+
+    @staticmethod
+    def empty():
+        return {
+            "attacks": 0,
+            "loot": {"wood": 0, "stone": 0, "iron": 0},
+            "sent": 0,
+            "lost": 0,
+            # Last report with heavy own losses and the last one without any
+            "dangerous_at": 0,
+            "clean_at": 0,
+            "last_seen": 0,
+        }
+
+    @staticmethod
+    def dangerous(stats):
+        # Heavy losses count until a farm after them came back without losses
+        return stats["dangerous_at"] > stats["clean_at"]
+
+    @staticmethod
+    def add(stats, entry):
+        extra = entry["extra"]
+        if entry["type"] == "attack":
+            stats["sent"] += sum(extra.get("units_sent", {}).values())
+            stats["lost"] += sum(extra.get("units_losses", {}).values())
+            if "loot" in extra:
+                stats["attacks"] += 1
+                for res, amount in extra["loot"].items():
+                    stats["loot"][res] = stats["loot"].get(res, 0) + int(amount)
+        # Own losses, light cavalry counts double
+        lost = sum(
+            amount * 2 if unit == "light" else amount
+            for unit, amount in entry["losses"].items()
+        )
+        when = int(extra.get("when", 0))
+        if lost > 10:
+            stats["dangerous_at"] = max(stats["dangerous_at"], when)
+        elif not lost:
+            stats["clean_at"] = max(stats["clean_at"], when)
+        stats["last_seen"] = max(stats["last_seen"], when)
+        return stats
+
+    @staticmethod
+    def ingest(entry):
+        if entry["type"] not in ["attack", "scout"] or not entry["dest"]:
+            return
+        with CacheStore.lock:
+            stats = CacheStore.get("farms", entry["dest"]) or FarmStats.empty()
+            CacheStore.set("farms", entry["dest"], FarmStats.add(stats, entry))
+
+    @staticmethod
+    def rebuild():
+        # One time build from the stored reports for caches from before the current farm totals
         output = {}
-        c_path = os.path.join("cache", "reports")
-        for existing in os.listdir(c_path):
-            if not existing.endswith(".json"):
-                continue
-            t_path = os.path.join("cache", "reports", existing)
-            with open(t_path, "r") as f:
-                output[existing.replace(".json", "")] = json.load(f)
+        with CacheStore.lock:
+            for vid in CacheStore.all("farms"):
+                CacheStore.delete("farms", vid)
+            for entry in ReportCache.cache_grab().values():
+                if entry["type"] not in ["attack", "scout"] or not entry["dest"]:
+                    continue
+                if entry["dest"] not in output:
+                    output[entry["dest"]] = FarmStats.empty()
+                FarmStats.add(output[entry["dest"]], entry)
+            CacheStore.set_many("farms", output)
+            CacheStore.set_meta("farm_stats", FarmStats.version)
         return output
+
+    @staticmethod
+    def cache_grab():
+        if CacheStore.get_meta("farm_stats") != str(FarmStats.version):
+            return FarmStats.rebuild()
+        return CacheStore.all("farms")
@@ -33,10 +33,16 @@ class ResourceManager:
     resources_kept_safe = {}
     resources_on_market = {}
     traded_resources = False
+    # Resources per hour from the mine levels and the time self.actual was read
+    production = {}
+    updated = 0
 
     def __init__(self, wrapper=None, village_id=None):
         self.wrapper = wrapper
         self.village_id = village_id
+        self.actual = {}
+        self.requested = {}
+        self.production = {}
 
     def update(self, game_state):
         self.actual["wood"] = game_state["village"]["wood"]
@@ -46,10 +52,71 @@ class ResourceManager:
             game_state["village"]["pop_max"] - game_state["village"]["pop"]
         )
         self.storage = game_state["village"]["storage_max"]
+        self.updated = time.time()
         self.check_state()
         self.continent = Extractor.continent(game_state["village"]["display_name"])
         self.logger = logging.getLogger(f'Resource Manager: {game_state["village"]["name"]}')
 
+    def update_from_overview(self, entry):
+        # Same as update() but from a production overview row, see Extractor.production_overview
+        self.actual["wood"] = entry["wood"]
+        self.actual["stone"] = entry["stone"]
+        self.actual["iron"] = entry["iron"]
+        self.actual["pop"] = entry["pop_max"] - entry["pop"]
+        self.storage = entry["storage_max"]
+        self.updated = time.time()
+        self.check_state()
+        if entry["display_name"]:
+            self.continent = Extractor.continent(entry["display_name"])
+        if not self.logger:
+            self.logger = logging.getLogger(f'Resource Manager: {entry["name"]}')
+
+    @staticmethod
+    def mine_production(level, world_speed=1):
+        # Resources per hour of a single mine, level 0 still produces a little
+        if not level:
+            return 5 * world_speed
+        return 30 * world_speed * 1.163118 ** (level - 1)
+
+    def set_production(self, levels, world_speed=1):
+        for res in ["wood", "stone", "iron"]:
+            self.production[res] = self.mine_production(levels.get(res, 0), world_speed)
+
+    def affordable_at(self, needed):
+        """
+        Timestamp at which the missing resources (the shortfalls in self.requested) are produced,
+        None when that never happens
+        """
+        at = self.updated
+        for res, missing in needed.items():
+            if res not in self.production or missing <= 0:
+                continue
+            if missing > self.storage or not self.production[res]:
+                return None
+            at = max(at, self.updated + missing / self.production[res] * 3600)
+        return int(at)
+
+    def overflow_at(self):
+        times = [
+            self.updated + (self.storage - self.actual[res]) / self.production[res] * 3600
+            for res in self.production
+            if self.production[res] and res in self.actual
+        ]
+        return int(min(times)) if times else None
+
+    def forecast(self):
+        """
+        When each open request becomes affordable with the current stock and production
+        """
+        output = {}
+        for source, needed in self.requested.items():
+            if not any(needed.values()):
+                continue
+            at = self.affordable_at(needed)
+            if at:
+                output[source] = at
+        return output
+
     def update_notify_resource(self, resource, amount):
         timestamp = int(time.time())
         self.last_notify[resource]["time"] = timestamp
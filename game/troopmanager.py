@@ -22,6 +22,8 @@ class TroopManager:
     troops = {}
 
     total_troops = {}
+    # Set once the units overview snapshot no longer matches because this village sent or trained units
+    totals_stale = True
 
     _research_wait = 0
 
@@ -66,6 +68,28 @@ class TroopManager:
         "snob": 35,
     }
 
+    unit_carry = {
+        "spear": 25,
+        "sword": 15,
+        "axe": 10,
+        "archer": 10,
+        "spy": 0,
+        "light": 80,
+        "marcher": 50,
+        "heavy": 50,
+        "ram": 0,
+        "catapult": 0,
+        "knight": 100,
+        "snob": 0,
+    }
+
+    # world speed * unit speed, see twb.py get_world_options
+    world_unit_speed = 1
+    world_speed = 1
+
+    # Share of the carried capacity each scavenging option brings home, used when the page has no option data
+    scavenge_loot_factors = {1: 0.10, 2: 0.25, 3: 0.50, 4: 0.75}
+
     wanted_levels = {}
 
     last_gather = 0
@@ -86,6 +110,22 @@ class TroopManager:
         # unit speed / world speed == speed per cell
         return self.unit_speeds[unit] / world_speed
 
+    def carry_capacity(self, units):
+        return sum(
+            [self.unit_carry.get(unit, 0) * int(units[unit]) for unit in units]
+        )
+
+    def travel_time(self, units, distance):
+        # Seconds to cover distance fields, a group of units moves at the speed of its slowest unit
+        speeds = [
+            self.calc_unit_speed(unit, self.world_unit_speed)
+            for unit in units
+            if unit in self.unit_speeds and int(units[unit]) > 0
+        ]
+        if not speeds:
+            return 0
+        return int(round(distance * max(speeds) * 60))
+
     def update_totals(self, first_run=False):
         # if self.total_troops != {} and not first_run:
         #     # No need to update if we already have the total!
@@ -114,11 +154,15 @@ class TroopManager:
         if not self.can_recruit:
             return
 
-        get_all = (
-            "game.php?village=%s&screen=place&mode=units&display=units"
-            % self.village_id
+        if not self.totals_stale and self.total_troops:
+            self.logger.debug("Village units total from overview: %s" % str(self.total_troops))
+            return
+
+        result_all = self.wrapper.get_action(
+            village_id=self.village_id,
+            action="place",
+            params={"mode": "units", "display": "units"},
         )
-        result_all = self.wrapper.get_url(get_all)
         self.total_troops = {}
         for u in Extractor.units_in_total(result_all):
             k, v = u
@@ -127,6 +171,13 @@ class TroopManager:
             else:
                 self.total_troops[k] = int(v)
         self.logger.debug("Village units total: %s" % str(self.total_troops))
+        self.totals_stale = False
+
+    def apply_overview(self, entry):
+        # Troops from the account wide units overview, see Extractor.units_overview
+        self.troops = {k: str(v) for k, v in entry["home"].items()}
+        self.total_troops = dict(entry["total"])
+        self.totals_stale = False
 
     def start_update(self, building="barracks", disabled_units=[]):
 
@@ -145,43 +196,38 @@ class TroopManager:
         if self.randomize_unit_queue:
             random.shuffle(run_selection)
 
+        # Units are handed over in order, the first ones get the resources first
+        missing = {}
         for wanted in run_selection:
             # Ignore disabled units
             if wanted in disabled_units:
                 continue
 
             if wanted not in self.total_troops:
-                if self.recruit(
-                    wanted, self.wanted[building][wanted], building=building
-                ):
-                    return True
+                missing[wanted] = self.wanted[building][wanted]
                 continue
 
             if self.wanted[building][wanted] > self.total_troops[wanted]:
-                if self.recruit(
-                    wanted,
-                    self.wanted[building][wanted] - self.total_troops[wanted],
-                    building=building,
-                ):
-                    return True
+                missing[wanted] = (
+                    self.wanted[building][wanted] - self.total_troops[wanted]
+                )
+
+        if missing and self.recruit_batch(missing, building=building):
+            return True
 
         self.logger.info("Recruitment:%s up-to-date" % building)
         return False
 
-    def get_min_possible(self, entry):
+    def get_min_possible(self, entry, available=None):
         # why i love python
+        if not available:
+            available = self.game_data["village"]
         return min(
             [
-                math.floor(self.game_data["village"]["wood"] / entry["wood"]),
-                math.floor(self.game_data["village"]["stone"] / entry["stone"]),
-                math.floor(self.game_data["village"]["iron"] / entry["iron"]),
-                math.floor(
-                    (
-                        self.game_data["village"]["pop_max"]
-                        - self.game_data["village"]["pop"]
-                    )
-                    / entry["pop"]
-                ),
+                math.floor(available["wood"] / entry["wood"]),
+                math.floor(available["stone"] / entry["stone"]),
+                math.floor(available["iron"] / entry["iron"]),
+                math.floor((available["pop_max"] - available["pop"]) / entry["pop"]),
             ]
         )
 
@@ -362,155 +408,151 @@ class TroopManager:
                 return True
         self.logger.info("Research of %s not yet possible" % unit_type)
 
-    def gather(self, selection=1, disabled_units=[]):
+    def scavenge_units(self, option):
+        # Offensive units stay home for the longer options
+        if option > 2:
+            can_use = ["spear", "sword", "heavy"]
+        else:
+            can_use = ["spear", "sword", "axe", "light", "heavy"]
+        if "archer" in self.total_troops:
+            can_use.extend(["archer", "marcher"])
+        return can_use
+
+    def scavenge_duration(self, option, carry, bases=None):
+        base = (bases or {}).get(option)
+        if not base:
+            base = {
+                "loot_factor": self.scavenge_loot_factors[option],
+                "duration_exponent": 0.45,
+                "duration_initial_seconds": 1800,
+                "duration_factor": self.world_speed ** -0.55,
+            }
+        loot = carry * base["loot_factor"]
+        return int(
+            ((loot ** 2 * 100) ** base["duration_exponent"] + base["duration_initial_seconds"])
+            * base["duration_factor"]
+        )
+
+    def scavenge_split(self, options, disabled_units=[], bases=None):
+        """
+        Splits the troops in the village over the idle scavenging options
+        Each option gets a carry capacity inversely to its loot factor so every squad brings the same loot and
+        returns at the same time. Options that take fewer unit types are filled first, what they can not
+        take is split again over the options after them
+        """
+        factors = {}
+        for option in options:
+            base = (bases or {}).get(option)
+            factors[option] = base["loot_factor"] if base else self.scavenge_loot_factors[option]
+        available = {}
+        for unit in self.unit_carry:
+            if unit in disabled_units or not self.unit_carry[unit] or unit == "knight":
+                continue
+            if int(self.troops.get(unit, 0)) > 0:
+                available[unit] = int(self.troops[unit])
+
+        order = sorted(options, key=lambda x: len(self.scavenge_units(x)))
+        squads = {option: {} for option in options}
+        for num, option in enumerate(order):
+            remaining = order[num:]
+            usable = set(
+                unit for x in remaining for unit in self.scavenge_units(x) if unit in available
+            )
+            carry = sum(available[unit] * self.unit_carry[unit] for unit in usable)
+            weight = sum(1 / factors[x] for x in remaining)
+            target = carry / factors[option] / weight
+            for unit in self.scavenge_units(option):
+                if unit not in available or target <= 0:
+                    continue
+                if option == order[-1]:
+                    amount = available[unit]
+                else:
+                    amount = min(available[unit], int(target // self.unit_carry[unit]))
+                if amount <= 0:
+                    continue
+                squads[option][unit] = amount
+                available[unit] -= amount
+                target -= amount * self.unit_carry[unit]
+        return squads
+
+    def gather(self, selection=4, disabled_units=[]):
+        """
+        Fills every unlocked and idle scavenging option up to selection with one send_squads request
+        """
         if not self.can_gather:
             return False
         if not self.logger:
             self.update_totals()
 
-        url = f"game.php?village={self.village_id}&screen=place&mode=scavenge"
-        result = self.wrapper.get_url(url=url)
+        result = self.wrapper.get_action(
+            village_id=self.village_id, action="place", params={"mode": "scavenge"}
+        )
         village_data = Extractor.village_data(result)
+        bases = Extractor.scavenge_options(result)
 
-        available_selection = 0
         self.first_gathering_back = None
-        send_new_gather = False
-        for option in reversed(sorted(village_data["options"].keys())):
-            if (
-                village_data["options"][option]["scavenging_squad"] != None
-                and "return_time" in village_data["options"][option]["scavenging_squad"]
-            ):
-                if self.first_gathering_back is None:
-                    self.first_gathering_back = village_data["options"][option][
-                        "scavenging_squad"
-                    ]["return_time"]
-                elif (
-                    village_data["options"][option]["scavenging_squad"]["return_time"]
-                    < self.first_gathering_back
+        idle = []
+        for option in sorted(village_data["options"].keys()):
+            squad = village_data["options"][option]["scavenging_squad"]
+            if squad is not None and "return_time" in squad:
+                if (
+                    self.first_gathering_back is None
+                    or squad["return_time"] < self.first_gathering_back
                 ):
-                    self.first_gathering_back = village_data["options"][option][
-                        "scavenging_squad"
-                    ]["return_time"]
+                    self.first_gathering_back = squad["return_time"]
 
             self.logger.debug(
-                f"Option: {option} Locked? {village_data['options'][option]['is_locked']} Is underway? {village_data['options'][option]['scavenging_squad'] != None }"
+                f"Option: {option} Locked? {village_data['options'][option]['is_locked']} Is underway? {squad != None }"
             )
             if (
-                int(option) == selection
+                int(option) <= selection
                 and not village_data["options"][option]["is_locked"]
-                and village_data["options"][option]["scavenging_squad"] is None
+                and squad is None
             ):
-                available_selection = int(option)
-                self.logger.info(
-                    f"Gather operation {available_selection} is ready to start."
-                )
-                selection = available_selection
-
-                troops = dict(self.troops)
-                can_use = [
-                        "spear:25",
-                        "sword:15",
-                        "axe:10",
-                        "light:80",
-                        "heavy:50",
-                        "knight:100"
-                    ]
-                if "archer" in self.total_troops:
-                    can_use.extend(["archer:10", "marcher:50"])
-                if selection > 2:
-                    can_use = [
-                        "spear:25",
-                        "sword:15",
-                        "heavy:50",
-                        "knight:100"
-                    ]
-                    if "archer" in self.total_troops:
-                        can_use.extend(["archer:10", "marcher:50"])
-                self.logger.info(f"Can use these: {can_use}")
-                payload = {
-                    "squad_requests[0][village_id]": self.village_id,
-                    "squad_requests[0][option_id]": str(selection),
-                    "squad_requests[0][use_premium]": "false",
-                }
-
-                total_carry = 0
-                used_troops = []
-                max_use = 100
-                for item in can_use:
-                    item, carry = item.split(":")
-                    if item == "knight":
-                        continue
-                    if item in disabled_units:
-                        continue
-                    if item in troops and int(troops[item]) > 0:
-                        if int(troops[item]) > max_use:
-                            payload[
-                                "squad_requests[0][candidate_squad][unit_counts][%s]"
-                                % item
-                            ] = max_use
-                            total_carry += int(carry) * max_use
-                        else:
-                            payload[
-                                "squad_requests[0][candidate_squad][unit_counts][%s]"
-                                % item
-                            ] = troops[item]
-                            total_carry += int(carry) * int(troops[item])
-                        used_troops.append(item)
-                    else:
-                        payload[f"squad_requests[0][candidate_squad][unit_counts][{item}]"] = "0"
-                payload["squad_requests[0][candidate_squad][carry_max]"] = str(
-                    total_carry
-                )
-                if total_carry > 50:
-                    payload["h"] = self.wrapper.last_h
-                    self.wrapper.get_api_action(
-                        action="send_squads",
-                        params={"screen": "scavenge_api"},
-                        data=payload,
-                        village_id=self.village_id,
-                    )
-                    self.last_gather = int(time.time())
-                    self.logger.info(
-                        f"Using troops {used_troops} for gather operation: {selection}"
-                    )
-                    send_new_gather = True
-                    for troop in used_troops:
-                        used = min([max_use, int(troops[troop])])
-                        self.troops[troop] = int(troops[troop]) - used
-                elif total_carry > 0:
-                    self.logger.info(
-                        f"Not enough troops to start gather operation: {used_troops} / {total_carry}"
-                    )
+                idle.append(int(option))
 
-            else:
-                # Gathering already exists or locked
-                pass
-
-        self.logger.info("All gather operations are underway.")
-        if self.first_gathering_back is None and send_new_gather:
-            url = "game.php?village=%s&screen=place&mode=scavenge" % self.village_id
-            result = self.wrapper.get_url(url=url)
-            village_data = Extractor.village_data(result)
-            for option in reversed(sorted(village_data["options"].keys())):
-                if (
-                    village_data["options"][option]["scavenging_squad"] != None
-                    and "return_time"
-                    in village_data["options"][option]["scavenging_squad"]
-                ):
-                    if self.first_gathering_back is None:
-                        self.first_gathering_back = village_data["options"][option][
-                            "scavenging_squad"
-                        ]["return_time"]
-                    elif (
-                        village_data["options"][option]["scavenging_squad"][
-                            "return_time"
-                        ]
-                        < self.first_gathering_back
-                    ):
-                        self.first_gathering_back = village_data["options"][option][
-                            "scavenging_squad"
-                        ]["return_time"]
+        if not idle:
+            self.logger.info("All gather operations are underway.")
+            return True
 
+        now = int(time.time())
+        payload = {}
+        sent = {}
+        for option, units in self.scavenge_split(idle, disabled_units, bases).items():
+            total_carry = self.carry_capacity(units)
+            if total_carry <= 50:
+                continue
+            prefix = "squad_requests[%d]" % len(sent)
+            payload["%s[village_id]" % prefix] = self.village_id
+            payload["%s[option_id]" % prefix] = str(option)
+            payload["%s[use_premium]" % prefix] = "false"
+            for unit, amount in units.items():
+                payload["%s[candidate_squad][unit_counts][%s]" % (prefix, unit)] = amount
+            payload["%s[candidate_squad][carry_max]" % prefix] = str(total_carry)
+            sent[option] = units
+            back = now + self.scavenge_duration(option, total_carry, bases)
+            if self.first_gathering_back is None or back < self.first_gathering_back:
+                self.first_gathering_back = back
+
+        if not sent:
+            self.logger.info(
+                f"Not enough troops to start gather operations: {idle}"
+            )
+            return True
+
+        payload["h"] = self.wrapper.last_h
+        self.wrapper.get_api_action(
+            action="send_squads",
+            params={"screen": "scavenge_api"},
+            data=payload,
+            village_id=self.village_id,
+        )
+        self.last_gather = now
+        self.totals_stale = True
+        for option, units in sent.items():
+            self.logger.info(f"Using troops {units} for gather operation: {option}")
+            for unit, amount in units.items():
+                self.troops[unit] = int(self.troops[unit]) - amount
         return True
 
     def cancel(self, building, id):
@@ -522,6 +564,13 @@ class TroopManager:
         )
 
     def recruit(self, unit_type, amount=10, wait_for=False, building="barracks"):
+        return self.recruit_batch({unit_type: amount}, wait_for, building)
+
+    def recruit_batch(self, units, wait_for=False, building="barracks"):
+        """
+        Recruits every unit in {unit_type: amount} that fits within the current resources and pop
+        using a single train request for the building
+        """
         data = self.wrapper.get_action(action=building, village_id=self.village_id)
 
         existing = Extractor.active_recruit_queue(data)
@@ -531,10 +580,10 @@ class TroopManager:
                 % (self.village_id, building)
             )
             if not self.can_fix_queue:
-                done_ats, units = Extractor.new_active_recruit_queue(data)
+                done_ats, queued = Extractor.new_active_recruit_queue(data)
                 self.wait_for[self.village_id][building] = int(done_ats[-1])
                 self.logger.info(
-                    f"Building {building} is currently busy building {units[-1]} until {self.readable_ts(int(done_ats[-1]))}"
+                    f"Building {building} is currently busy building {queued[-1]} until {self.readable_ts(int(done_ats[-1]))}"
                 )
                 return True
             for entry in existing:
@@ -542,58 +591,60 @@ class TroopManager:
                 self.logger.info(
                     "Canceled recruit item %s on building %s" % (entry, building)
                 )
-            return self.recruit(unit_type, amount, wait_for, building)
+            return self.recruit_batch(units, wait_for, building)
 
         self.recruit_data = Extractor.recruit_data(data)
         self.game_data = Extractor.game_state(data)
-        self.logger.info("Attempting recruitment of %d %s" % (amount, unit_type))
-
-        if amount > self.max_batch_size:
-            amount = self.max_batch_size
-
-        if unit_type not in self.recruit_data:
-            self.logger.warning(
-                "Recruitment of %d %s failed because it is not researched"
-                % (amount, unit_type)
-            )
-            self.attempt_research(unit_type)
-            return False
 
-        resources = self.recruit_data[unit_type]
-        if not resources:
-            self.logger.warning(
-                "Recruitment of %d %s failed because invalid identifier"
-                % (amount, unit_type)
-            )
-            return False
-        if not resources["requirements_met"]:
-            self.logger.warning(
-                "Recruitment of %d %s failed because it is not researched"
-                % (amount, unit_type)
-            )
-            self.attempt_research(unit_type)
-            return False
+        # Resources still free after the units already added to this batch
+        available = dict(self.game_data["village"])
+        batch = {}
+        build_time = 0
+        for unit_type, amount in units.items():
+            if amount > self.max_batch_size:
+                amount = self.max_batch_size
 
-        get_min = self.get_min_possible(resources)
-        if get_min == 0:
-            self.logger.info(
-                "Recruitment of %d %s failed because of not enough resources"
-                % (amount, unit_type)
-            )
-            self.reserve_resources(resources, amount, get_min, unit_type)
-            return False
+            if unit_type not in self.recruit_data:
+                self.logger.warning(
+                    "Recruitment of %d %s failed because it is not researched"
+                    % (amount, unit_type)
+                )
+                self.attempt_research(unit_type)
+                continue
 
-        needed_reserve = False
-        if get_min < amount:
-            if wait_for:
+            resources = self.recruit_data[unit_type]
+            if not resources:
+                self.logger.warning(
+                    "Recruitment of %d %s failed because invalid identifier"
+                    % (amount, unit_type)
+                )
+                continue
+            if not resources["requirements_met"]:
                 self.logger.warning(
+                    "Recruitment of %d %s failed because it is not researched"
+                    % (amount, unit_type)
+                )
+                self.attempt_research(unit_type)
+                continue
+
+            get_min = self.get_min_possible(resources, available=available)
+            if get_min == 0:
+                self.logger.info(
                     "Recruitment of %d %s failed because of not enough resources"
                     % (amount, unit_type)
                 )
                 self.reserve_resources(resources, amount, get_min, unit_type)
-                needed_reserve = True
-                return False
-            if get_min > 0:
+                continue
+
+            needed_reserve = False
+            if get_min < amount:
+                if wait_for:
+                    self.logger.warning(
+                        "Recruitment of %d %s failed because of not enough resources"
+                        % (amount, unit_type)
+                    )
+                    self.reserve_resources(resources, amount, get_min, unit_type)
+                    continue
                 self.logger.info(
                     "Recruitment of %d %s was set to %d because of resources"
                     % (amount, unit_type, get_min)
@@ -602,43 +653,42 @@ class TroopManager:
                 amount = get_min
                 needed_reserve = True
 
-        if not needed_reserve:
-            # No need to reserve resources anymore!
-            if f"recruitment_{unit_type}" in self.resman.requested:
-                self.resman.requested.pop(f"recruitment_{unit_type}", None)
+            if not needed_reserve:
+                # No need to reserve resources anymore!
+                if f"recruitment_{unit_type}" in self.resman.requested:
+                    self.resman.requested.pop(f"recruitment_{unit_type}", None)
 
+            for res in ["wood", "stone", "iron"]:
+                available[res] -= resources[res] * amount
+            available["pop"] += resources["pop"] * amount
+            batch[unit_type] = amount
+            build_time += amount * int(resources["build_time"])
+
+        if not batch:
+            return False
+
+        self.logger.info("Attempting recruitment of %s" % str(batch))
         result = self.wrapper.get_api_action(
             village_id=self.village_id,
             action="train",
             params={"screen": building, "mode": "train"},
-            data={"units[%s]" % unit_type: str(amount)},
+            data={"units[%s]" % unit_type: str(amount) for unit_type, amount in batch.items()},
         )
-        if "game_data" in result:
+        if result and "game_data" in result:
+            self.totals_stale = True
             self.resman.update(result["game_data"])
             self.game_data = result["game_data"]
-            self.wait_for[self.village_id][building] = int(time.time()) + (
-                amount * int(resources["build_time"])
-            )
-            # self.troops[unit_type] = str((int(self.troops[unit_type]) if unit_type in self.troops else 0) + amount)
+            self.wait_for[self.village_id][building] = int(time.time()) + build_time
+            summary = ", ".join(["%d %s" % (amount, unit_type) for unit_type, amount in batch.items()])
             self.logger.info(
-                "Recruitment of %d %s started (%s idle till %d)"
-                % (
-                    amount,
-                    unit_type,
-                    building,
-                    self.wait_for[self.village_id][building],
-                )
+                "Recruitment of %s started (%s idle till %d)"
+                % (summary, building, self.wait_for[self.village_id][building])
             )
             self.wrapper.reporter.report(
                 self.village_id,
                 "TWB_RECRUIT",
-                "Recruitment of %d %s started (%s idle till %d)"
-                % (
-                    amount,
-                    unit_type,
-                    building,
-                    self.wait_for[self.village_id][building],
-                ),
+                "Recruitment of %s started (%s idle till %d)"
+                % (summary, building, self.wait_for[self.village_id][building]),
             )
             return True
         return False
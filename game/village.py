@@ -2,19 +2,19 @@ from codecs import decode
 from datetime import datetime, timedelta
 import logging
 import json
-import os
 import time
 import random
 
 from game.buildingmanager import BuildingManager
 from game.troopmanager import TroopManager
 from game.attack import AttackManager
-from game.map import Map
+from game.map import Map, WorldMap
 from game.resources import ResourceManager
 from game.defence_manager import DefenceManager
 from game.reports import ReportManager
 from game.snobber import SnobManager
 
+from core.cachestore import CacheStore
 from core.extractors import Extractor
 from core.templates import TemplateManager
 from core.twplus import TwPlus
@@ -30,6 +30,8 @@ class Village:
     logger = None
     force_troops = False
     area = None
+    world_map = None
+    farm_planner = None
     snobman = None
     attack = None
     resman = None
@@ -77,8 +79,40 @@ class Village:
             return stne
         return 0
 
+    def apply_overview(self, entry):
+        # Resources from the account wide production overview, before any own screen is loaded
+        if not self.resman:
+            self.resman = ResourceManager(
+                wrapper=self.wrapper, village_id=self.village_id
+            )
+        self.resman.update_from_overview(entry)
+
+    def has_work(self):
+        """
+        Whether a run would do anything according to the production overview
+        Only villages that ran before and are waiting for resources they do not have yet are skipped
+        """
+        if not self.logger or not self.config or not self.resman or not self.resman.actual:
+            return True
+        if self.get_config(section="farms", parameter="farm", default=False):
+            return True
+        if self.get_village_config(
+            self.village_id, parameter="gather_enabled", default=False
+        ):
+            return True
+        if self.resman.any_resource_full() or not self.resman.requested:
+            return True
+        for source in self.resman.requested:
+            # check_state sets every satisfied amount to 0
+            if all(x == 0 for x in self.resman.requested[source].values()):
+                return True
+        return False
+
     def determine_next_back(self, res):
         outgoing, returning = Extractor.active_attacks(res)
+        if self.attack:
+            # Farms sent this run are still outgoing on the overview, their return is predicted
+            returning.extend(self.attack.predicted_returns())
 
         if len(returning) > 0:
             tsdtn = datetime.now().timestamp()
@@ -138,6 +172,20 @@ class Village:
                     self.units.wait_for[self.village_id][building],
                 )
 
+    def determine_resources_ready(self):
+        # Wake up when a waiting request can be paid or before the storage runs over
+        if not self.resman or not self.builder or not self.resman.updated:
+            return
+        self.resman.set_production(
+            self.builder.levels,
+            self.get_config(section="world", parameter="speed", default=1),
+        )
+        for source, at in self.resman.forecast().items():
+            self.set_next_event("resources_%s" % source, at)
+        overflow = self.resman.overflow_at()
+        if overflow:
+            self.set_next_event("storage_full", overflow)
+
     def get_config(self, section, parameter, default=None):
         if section not in self.config:
             self.logger.warning("Configuration section %s does not exist!" % section)
@@ -161,6 +209,18 @@ class Village:
             return default
         return vdata[parameter]
 
+    def setup_map(self):
+        if not self.world_map:
+            self.world_map = WorldMap()
+        if not self.area:
+            self.area = Map(
+                wrapper=self.wrapper, village_id=self.village_id, world=self.world_map
+            )
+        self.area.radius = self.get_config(
+            section="farms", parameter="search_radius", default=50
+        )
+        return self.area
+
     def setup_builder(self):
         if not self.builder:
             self.builder = BuildingManager(
@@ -420,8 +480,7 @@ class Village:
         # attack management
         if not forced_peace and not resources_full and self.units.can_attack:
 
-            if not self.area:
-                self.area = Map(wrapper=self.wrapper, village_id=self.village_id)
+            self.setup_map()
             self.area.get_map()
             if self.area.villages:
                 self.units.can_scout = self.get_config(
@@ -442,6 +501,7 @@ class Village:
                         map=self.area,
                     )
                     self.attack.repman = self.rep_man
+                self.attack.planner = self.farm_planner
                 if forced_peace_today:
                     self.logger.info("Forced peace time coming up today!")
                     self.attack.forced_peace_time = forced_peace_today_start
@@ -461,12 +521,18 @@ class Village:
                 self.attack.farm_default_wait = self.get_config(
                     section="farms", parameter="default_away_time", default=1200
                 )
-                self.attack.farm_high_prio_wait = self.get_config(
-                    section="farms", parameter="full_loot_away_time", default=1800
-                )
                 self.attack.farm_low_prio_wait = self.get_config(
                     section="farms", parameter="low_loot_away_time", default=7200
                 )
+                self.units.world_unit_speed = self.get_config(
+                    section="world", parameter="world_unit_speed", default=1
+                )
+                self.attack.world_speed = self.get_config(
+                    section="world", parameter="speed", default=1
+                )
+                self.attack.use_loot_assistant = self.get_config(
+                    section="farms", parameter="use_loot_assistant", default=False
+                )
                 entry = self.units.get_template_action(self.builder.levels)
                 self.logger.debug(f"Building levels: {self.builder.levels}")
                 self.logger.debug(f"Template: {entry}")
@@ -486,6 +552,8 @@ class Village:
                         section="farms", parameter="max_farms", default=25
                     )
                     self.attack.run()
+                    if self.farm_planner:
+                        self.farm_planner.done(self.village_id)
         # Gathering too
         self.units.can_gather = self.get_village_config(
             self.village_id, parameter="gather_enabled", default=False
@@ -502,9 +570,12 @@ class Village:
             ):
                 disabled_units.extend(["ram", "catapult"])
             if not self.def_man or not self.def_man.under_attack:
+                self.units.world_speed = self.get_config(
+                    section="world", parameter="speed", default=1
+                )
                 self.units.gather(
                     selection=self.get_village_config(
-                        self.village_id, parameter="gather_selection", default=1
+                        self.village_id, parameter="gather_selection", default=4
                     ),
                     disabled_units=disabled_units,
                 )
@@ -576,6 +647,8 @@ class Village:
         self.wrapper.delay = self.get_config(
             section="bot", parameter="delay_factor", default=1.0
         )
+        # New cycle for this village, anything cached during the previous one is outdated
+        self.wrapper.clear_cache()
         if not self.village_id:
             data = self.wrapper.get_url("game.php?screen=overview&intro")
             if data:
@@ -587,8 +660,8 @@ class Village:
                 )
                 self.logger.info("Read game state for village")
         else:
-            data = self.wrapper.get_url(
-                "game.php?village=%s&screen=overview" % self.village_id
+            data = self.wrapper.get_action(
+                village_id=self.village_id, action="overview"
             )
             if data:
                 self.game_data = Extractor.game_state(data)
@@ -643,13 +716,17 @@ class Village:
             self.rep_man = ReportManager(
                 wrapper=self.wrapper, village_id=self.village_id
             )
+        # Market reports are needed to notice accepted trades
+        self.rep_man.read_trades = self.get_config(
+            section="market", parameter="auto_trade", default=False
+        )
         self.rep_man.read(full_run=False)
 
         if not self.def_man:
             self.def_man = DefenceManager(
                 wrapper=self.wrapper, village_id=self.village_id
             )
-            self.def_man.map = self.area
+            self.def_man.map = self.setup_map()
 
         if not self.def_man.units:
             self.def_man.units = self.units
@@ -857,6 +934,4 @@ class Village:
         self.set_cache(self.village_id, entry=village_entry)
 
     def set_cache(self, village_id, entry):
-        t_path = os.path.join("cache", "managed", village_id + ".json")
-        with open(t_path, "w") as f:
-            return json.dump(entry, f)
+        return CacheStore.set("managed", village_id, entry)
@@ -1,9 +1,9 @@
 import json
-import os
 import logging
 import sys
 
-from game.reports import ReportCache
+from core.cachestore import CacheStore
+from game.reports import FarmStats
 from game.attack import AttackCache
 
 class VillageManager:
@@ -16,36 +16,24 @@ class VillageManager:
         if verbose:
             logger.info("Villages: %d", len(config["villages"]))
         attacks = AttackCache.cache_grab()
-        reports = ReportCache.cache_grab()
+        farm_stats = FarmStats.cache_grab()
 
         if verbose:
-            logger.info("Reports: %d", len(reports))
+            logger.info("Reports: %d", CacheStore.count("reports"))
             logger.info("Farms: %d", len(attacks))
         t = {"wood": 0, "iron": 0, "stone": 0}
         for farm in attacks:
             data = attacks[farm]
+            stats = farm_stats.get(farm) or FarmStats.empty()
+            changed = False
 
-            num_attack = []
-            loot = {"wood": 0, "iron": 0, "stone": 0}
-            total_loss_count = 0
-            total_sent_count = 0
-            for rep in reports:
-                if reports[rep]["dest"] == farm and reports[rep]["type"] == "attack":
-                    for unit in reports[rep]["extra"]["units_sent"]:
-                        total_sent_count += reports[rep]["extra"]["units_sent"][unit]
-                    for unit in reports[rep]["extra"]["units_losses"]:
-                        total_loss_count += reports[rep]["extra"]["units_losses"][unit]
-                    try:
-                        res = reports[rep]["extra"]["loot"]
-                        for r in res:
-                            loot[r] = loot[r] + int(res[r])
-                            t[r] = t[r] + int(res[r])
-                        num_attack.append(reports[rep])
-                    except:
-                        pass
+            num_attack = stats["attacks"]
+            loot = stats["loot"]
+            for r in loot:
+                t[r] = t.get(r, 0) + loot[r]
             percentage_lost = 0
-            if total_sent_count > 0:
-                percentage_lost = total_loss_count / total_sent_count * 100
+            if stats["sent"] > 0:
+                percentage_lost = stats["lost"] / stats["sent"] * 100
 
             perf = "Normal Profile "
             if data["high_profile"]:
@@ -55,89 +43,74 @@ class VillageManager:
             if verbose:
                 logger.info(
                     "%sFarm village %s attacked %d times - Total loot: %s - Total units lost: %s (%s)",
-                    perf, farm, len(num_attack), str(loot), str(total_loss_count), str(round(percentage_lost, 2))
+                    perf, farm, num_attack, str(loot), str(stats["lost"]), str(round(percentage_lost, 2))
                 )
-            if len(num_attack):
-                total = 0
-                for k in loot:
-                    total += loot[k]
-                if len(num_attack) > 3:
-                    if total / len(num_attack) < 100 and (
-                        "low_profile" not in data or not data["low_profile"]
-                    ):
-                        if verbose:
-                            logger.info(
-                                "Farm %s has very low resources (%d avg total), extending farm time",
-                                farm, total / len(num_attack)
-                            )
-                        data["low_profile"] = True
-                        AttackCache.set_cache(farm, data)
-                    elif total / len(num_attack) >= 100 and (
-                        "low_profile" in data and data["low_profile"]
-                    ):
-                        if verbose:
-                            logger.info(
-                                "Farm %s had very low resources, now back up to normal? (%d avg total), resetting farm time"
-                                % (farm, total / len(num_attack))
-                            )
-                        data["low_profile"] = False
-                        AttackCache.set_cache(farm, data)
-                    elif total / len(num_attack) > 500 and (
-                        "high_profile" not in data or not data["high_profile"]
-                    ):
-                        if verbose:
-                            logger.info(
-                                "Farm %s has very high resources (%d avg total), setting to high profile",
-                                farm, total / len(num_attack)
-                            )
-                        data["high_profile"] = True
-                        AttackCache.set_cache(farm, data)
-
-            if percentage_lost > 20 and not data["low_profile"]:
+            dangerous = FarmStats.dangerous(stats)
+            if percentage_lost > 20 and not data.get("low_profile"):
                 logger.warning(
                     f"Dangerous {percentage_lost} percentage lost units! Extending farm time"
                 )
                 data["low_profile"] = True
                 data["high_profile"] = False
-                AttackCache.set_cache(farm, data)
-            # if percentage_lost > 50 and len(num_attack) > 10:
+                changed = True
+            # if percentage_lost > 50 and num_attack > 10:
             #     print("[Farm Manager] Farm seems too dangerous/ unprofitable to farm. Setting safe to false!")
             #     data["safe"] = False
-            #     AttackCache.set_cache(farm, data)
+            #     changed = True
+
+            if dangerous and not data.get("low_profile"):
+                if verbose:
+                    logger.info(
+                        f"[Farm Manager] Dangerous: {farm} -> heavy losses since the last clean farm, extending farm time"
+                    )
+                data["low_profile"] = True
+                changed = True
 
-        for report in reports:
-            r = reports[report]
-            total_loss_count = 0
-            if r["type"] == "scout" or r["type"] == "attack":
-                if r["losses"] != {}:
-                    for unit in r["losses"]:
-                        total_loss_count += (
-                            r["losses"][unit] * 2
-                            if unit == "light"
-                            else r["losses"][unit]
+            # Farms kept on low profile for losses are not reset by their loot
+            risky = dangerous or percentage_lost > 20
+            if num_attack > 3:
+                average = sum(loot.values()) / num_attack
+                if average < 100 and (
+                    "low_profile" not in data or not data["low_profile"]
+                ):
+                    if verbose:
+                        logger.info(
+                            "Farm %s has very low resources (%d avg total), extending farm time",
+                            farm, average
                         )
-                    if total_loss_count > 10 and verbose:
+                    data["low_profile"] = True
+                    changed = True
+                elif average >= 100 and not risky and (
+                    "low_profile" in data and data["low_profile"]
+                ):
+                    if verbose:
                         logger.info(
-                            f"[Farm Manager] Dangerous: {r} -> {total_loss_count} total loss count, extending farm time"
+                            "Farm %s had very low resources, now back up to normal? (%d avg total), resetting farm time"
+                            % (farm, average)
                         )
-                    if total_loss_count > 10:
-                        data["low_profile"] = True
-                        AttackCache.set_cache(farm, data)
+                    data["low_profile"] = False
+                    changed = True
+                elif average > 500 and not risky and (
+                    "high_profile" not in data or not data["high_profile"]
+                ):
+                    if verbose:
+                        logger.info(
+                            "Farm %s has very high resources (%d avg total), setting to high profile",
+                            farm, average
+                        )
+                    data["high_profile"] = True
+                    changed = True
+
+            if changed:
+                AttackCache.set_cache(farm, data)
 
         if verbose:
             logger.info("Total loot: %s" % t)
 
         if clean_reports:
-            list_of_files = sorted(["./cache/reports/" + f for f in os.listdir("./cache/reports/")],
-            key=os.path.getctime,
-        )
-
-            logger.info(f"Found {len(list_of_files)} files")
-
-            while len(list_of_files) > clean_reports:
-                oldest_file = list_of_files.pop(0)
-                logger.info(f"Delete old report ({oldest_file})")
-                os.remove(os.path.abspath(oldest_file))
+            logger.info(f"Found {CacheStore.count('reports')} reports")
+            removed = CacheStore.remove_oldest("reports", keep=clean_reports)
+            logger.info(f"Deleted {removed} old reports")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+import os
+
+from core.extractors import Extractor
+from utilities import benchmark
+
+PAGES = os.path.join(os.path.dirname(__file__), "pages")
+# Generous per page budget, the saved pages take well under a millisecond per extractor
+MAX_MS = 5.0
+
+
+def pages():
+    return benchmark.load_pages(PAGES)
+
+
+def test_extractors_on_saved_pages():
+    loaded = pages()
+    overview = loaded["overview"][0]
+    assert Extractor.parse_csrf_token(overview) == "2f1c7a9e"
+    assert Extractor.parse_h(overview) == "8c4b12ef"
+    assert Extractor.parse_game_state(overview)["village"]["id"] == 12345
+    assert Extractor.parse_units_in_village(overview) == [("spear", "120"), ("light", "45"), ("spy", "8")]
+    assert Extractor.parse_active_attacks(overview) == ([1760781240, 1760782380], [1760781900])
+    assert Extractor.get_quests(overview) == "1010"
+
+    main = loaded["main"][0]
+    assert Extractor.new_active_building_queue(main) == ([1760785412, 1760790514], ["main", "wood"])
+    assert Extractor.active_building_queue(main) == 2
+    assert Extractor.building_data(main)["barracks"]["level"] == "8"
+
+    place = loaded["place"][0]
+    assert Extractor.units_in_total(place) == [("spear", "120"), ("light", "45"), ("spy", "8")]
+    assert Extractor.attack_duration(place) == 754
+
+    market = loaded["market"][0]
+    assert Extractor.merchants_available(market) == 11
+    assert Extractor.premium_exchange_rate(market) == {"wood": 410, "stone": 462, "iron": 601}
+
+    scavenge = loaded["scavenge"][0]
+    assert sorted(Extractor.scavenge_options(scavenge)) == [1, 2, 3, 4]
+    assert Extractor.scavenge_options(scavenge)[4]["loot_factor"] == 0.75
+
+    villages = loaded["overview_villages"][0]
+    production = Extractor.production_overview(villages)
+    assert production["12345"]["wood"] == 4120
+    assert production["12346"]["storage_max"] == 4526
+    assert production["12346"]["pop_max"] == 847
+    units = Extractor.units_overview(villages)
+    assert units["12345"]["home"]["light"] == 45
+    assert units["12345"]["total"]["light"] == 95
+    assert Extractor.incomings_overview(villages) == {"12346": [1760784005, 1760789120]}
+
+
+def test_extractor_parse_time():
+    results = benchmark.run(pages(), rounds=20)
+    assert results
+    slow = {key: ms for key, ms in results.items() if ms > MAX_MS}
+    assert not slow, "Extractors over %.1f ms per page: %s" % (MAX_MS, slow)
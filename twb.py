@@ -15,8 +15,15 @@ import git
 
 from git import Repo
 from utilities.git import Git
+from core.cachestore import CacheStore
 from core.extractors import Extractor
+from core.replay import replay_cache
 from core.request import WebWrapper
+from core.scheduler import VillageScheduler
+from game.balancer import ResourceBalancer
+from game.farmplanner import FarmPlanner
+from game.incomings import IncomingsMonitor
+from game.map import WorldMap
 from game.village import Village
 from manager import VillageManager
 
@@ -39,9 +46,25 @@ class TWB:
     should_run = True
     runs = 0
     world_unit_speed = 1
+    scheduler = None
+    incomings = None
+    # --record stores every request in cache/recordings, --replay <archive> runs one offline sweep from it
+    record_path = None
+    replay_path = None
     logger = logging.getLogger("TWB")
 
+    def __init__(self):
+        if "--record" in sys.argv:
+            self.record_path = os.path.join(
+                "cache", "recordings", "session_%d.jsonl.gz" % int(time.time())
+            )
+        if "--replay" in sys.argv:
+            self.replay_path = sys.argv[sys.argv.index("--replay") + 1]
+            CacheStore.path = replay_cache(self.replay_path)
+
     def internet_online(self):
+        if self.replay_path:
+            return True
         try:
             requests.get("https://github.com/stefan2200/TWB", timeout=(10, 60))
             return True
@@ -155,7 +178,10 @@ class TWB:
         return new_config
 
     def get_overview(self, config):
-        result_get = self.wrapper.get_url("game.php?screen=overview_villages")
+        # The production overview also carries the resources of every village
+        result_get = self.wrapper.get_url(
+            "game.php?screen=overview_villages&mode=prod&page=-1"
+        )
         result_villages = None
         has_new_villages = False
         if config["bot"].get("add_new_villages", False):
@@ -233,6 +259,39 @@ class TWB:
 
         return changed, config
 
+    def check_incomings(self, defense_states):
+        new_targets = self.incomings.poll()
+        now = time.time()
+        for vil in self.villages:
+            if vil.village_id in new_targets:
+                # Run the attacked village right away instead of at its next event
+                self.scheduler.schedule(vil.village_id, now, kind="incoming")
+            if not vil.def_man:
+                continue
+            vil.def_man.arrivals = self.incomings.upcoming(vil.village_id)
+            if vil.def_man.arrivals:
+                vil.def_man.under_attack = True
+            if vil.village_id in defense_states:
+                defense_states[vil.village_id] = (
+                    vil.def_man.under_attack if vil.def_man.allow_support_recv else False
+                )
+        if len(defense_states):
+            for vil in self.villages:
+                if vil.def_man:
+                    vil.def_man.my_other_villages = defense_states
+        return new_targets
+
+    def idle(self, sleep, defense_states, poll=True):
+        # Sleep in slices of the incomings interval, a new attack ends the sleep early
+        if not poll:
+            time.sleep(sleep)
+            return
+        until = time.time() + sleep
+        while time.time() < until:
+            time.sleep(max(0, min(self.incomings.interval, until - time.time())))
+            if self.check_incomings(defense_states):
+                return
+
     def run(self):
         config = self.config()
         if not self.internet_online():
@@ -266,7 +325,9 @@ class TWB:
             discord_notifier=config["discord_notify"]["enabled"],
             discord_notifier_endpoint=config["discord_notify"]["endpoint"],
             proxy_enabled=config["proxy"]["enabled"],
-            proxy_endpoint=config["proxy"]["endpoint"],            
+            proxy_endpoint=config["proxy"]["endpoint"],
+            record_path=self.record_path,
+            replay_path=self.replay_path,
         )
 
         self.wrapper.start()
@@ -283,8 +344,17 @@ class TWB:
             self.villages.append(copy.deepcopy(v))
         # setup additional builder
         rm = None
+        world_map = WorldMap()
+        farm_planner = FarmPlanner()
+        balancer = ResourceBalancer(wrapper=self.wrapper)
         defense_states = {}
+        self.scheduler = VillageScheduler()
+        self.incomings = IncomingsMonitor(
+            wrapper=self.wrapper,
+            interval=config["bot"].get("incomings_interval", 120),
+        )
         self.wrapper.discord.send("TWB starting...")
+        started = time.time()
         while self.should_run:
             if not self.internet_online():
                 self.logger.info("Internet seems to be down, waiting till its back online...")
@@ -316,19 +386,58 @@ class TWB:
                     with open("config.json", "w") as newcf:
                         json.dump(config, newcf, indent=2, sort_keys=False)
                         self.logger.info("Deployed new configuration file")
-                vnum = 1
-                seconds_till_next_event = 1000000000000000000000000000000
-                for vil in list(set(self.villages)):
+                production = Extractor.production_overview(res_text)
+                active_delay = config["bot"]["active_delay"]
+                max_idle = config["bot"].get("max_village_idle", 3600)
+                self.incomings.interval = config["bot"].get("incomings_interval", 120)
+                self.check_incomings(defense_states)
+                now = time.time()
+                for vil in self.villages:
+                    if not self.scheduler.is_scheduled(vil.village_id):
+                        self.scheduler.schedule(vil.village_id, now, kind="init")
+                due = dict(self.scheduler.pop_due(now))
+                if rm:
+                    # The first village of this cycle reads the new reports for the whole account
+                    rm.new_cycle()
+                self.logger.info(
+                    "%d out of %d villages have an event due" % (len(due), len(self.villages))
+                )
+                troops = {}
+                if due:
+                    # One units overview instead of a place screen per village
+                    units_overview = self.wrapper.get_url(
+                        "game.php?screen=overview_villages&mode=units&type=complete&page=-1"
+                    )
+                    if units_overview:
+                        troops = Extractor.units_overview(units_overview)
+                farm_planner.new_cycle(due, troops)
+                # Only villages that actually run this cycle are counted
+                vnum = 0
+                for vil in self.villages:
+                    if vil.village_id not in due:
+                        continue
                     if result_villages and vil.village_id not in result_villages:
                         self.logger.info(
                             "Village %s will be ignored because it is not available anymore"
                             % vil.village_id
                         )
+                        self.scheduler.schedule(vil.village_id, now + active_delay, kind="unavailable")
                         continue
                     if not rm:
                         rm = vil.rep_man
                     else:
                         vil.rep_man = rm
+                    vil.world_map = world_map
+                    vil.farm_planner = farm_planner
+                    if vil.units and vil.village_id in troops:
+                        vil.units.apply_overview(troops[vil.village_id])
+                    if vil.village_id in production:
+                        vil.apply_overview(production[vil.village_id])
+                        if due[vil.village_id] == "active_delay" and not vil.has_work():
+                            vil.logger.info("Nothing to do, waiting for resources")
+                            self.scheduler.schedule(vil.village_id, now + active_delay, kind="active_delay")
+                            continue
+                    vnum += 1
                     if (
                         "auto_set_village_names" in config["bot"]
                         and config["bot"]["auto_set_village_names"]
@@ -343,6 +452,7 @@ class TWB:
                         template = template.replace("{num}", num_pad)
                         vil.village_set_name = template
 
+                    self.logger.debug("Running village %s (%s)" % (vil.village_id, due[vil.village_id]))
                     vil.next_event = {"kind": None, "time": None}
                     vil.run(config=config, first_run=vnum == 1)
                     if (
@@ -359,9 +469,24 @@ class TWB:
                     vil.determine_next_building_done()
                     vil.determine_next_recruitment()
                     vil.determine_first_gather_back()
-                    if seconds_till_next_event > vil.get_seconds_till_next_event():
-                        seconds_till_next_event = vil.get_seconds_till_next_event()
-                    vnum += 1
+                    vil.determine_resources_ready()
+                    # Wake the village at its own next event, but never sooner than active_delay
+                    # and never later than max_village_idle
+                    finished = time.time()
+                    next_time = finished + active_delay
+                    next_kind = "active_delay"
+                    if vil.logger and vil.get_seconds_till_next_event() > active_delay:
+                        next_time = min(vil.next_event["time"], finished + max_idle)
+                        next_kind = vil.next_event["kind"]
+                    self.scheduler.schedule(vil.village_id, next_time, kind=next_kind)
+
+                if due and config["market"].get("balance_resources", False):
+                    # Villages that ran have their own end of run resources, the others get this cycle's overview
+                    for vil in self.villages:
+                        if vil.village_id not in due and vil.village_id in production:
+                            vil.apply_overview(production[vil.village_id])
+                    balancer.world_speed = config["world"].get("world_unit_speed", 1)
+                    balancer.run(self.villages)
 
                 if len(defense_states) and config["farms"]["farm"]:
                     for vil in self.villages:
@@ -371,18 +496,15 @@ class TWB:
                 sleep = 0
                 active_h = [int(x) for x in config["bot"]["active_hours"].split("-")]
                 get_h = time.localtime().tm_hour
+                # No incomings polls while the bot is set to be dormant
+                poll_incomings = True
                 if get_h in range(active_h[0], active_h[1]):
-                    sleep = config["bot"]["active_delay"]
+                    seconds_till_next_event = self.scheduler.seconds_till_next()
+                    _, next_vid, next_kind = self.scheduler.next_due()
+                    sleep = seconds_till_next_event if seconds_till_next_event is not None else active_delay
                     self.logger.info(
-                        f"Seconds until next event for a village: {round(seconds_till_next_event, 2)}"
+                        f"Seconds until next event: {round(sleep, 2)} (village {next_vid}: {next_kind})"
                     )
-                    # if sleep > seconds_till_next_event:
-                    #     print("Sleep would be more than the next event for a village!")
-                    if sleep < seconds_till_next_event:
-                        self.logger.info(
-                            "Sleep is less than the next event for a village! Delaying until next event..."
-                        )
-                        sleep = seconds_till_next_event
                 else:
                     if config["bot"]["inactive_still_active"]:
                         sleep = config["bot"]["inactive_delay"]
@@ -391,19 +513,27 @@ class TWB:
                             "Getting 7 hours of sleep! Probally the session will time-out!!"
                         )
                         sleep = 25200
+                        poll_incomings = False
 
                 sleep += random.randint(20, 120)
                 dtn = datetime.datetime.now()
                 dt_next = dtn + datetime.timedelta(0, sleep)
                 self.runs += 1
 
-                VillageManager.farm_manager(verbose=True)
+                if due:
+                    VillageManager.farm_manager(verbose=True)
+                if self.wrapper.replaying:
+                    self.logger.info(
+                        "Replay finished: %d villages, %d requests in %.2f seconds"
+                        % (len(due), self.wrapper.request_count, time.time() - started)
+                    )
+                    return True
                 self.logger.info(
                     "Dead for %f minutes (next run at: %s)"
                     % (round(sleep / 60, 2), dt_next.time())
                 )
                 sys.stdout.flush()
-                time.sleep(sleep)
+                self.idle(sleep, defense_states, poll=poll_incomings)
 
     def start(self):
         if not os.path.exists("cache"):
@@ -422,15 +552,17 @@ class TWB:
             os.mkdir(os.path.join("cache", "managed"))
         if not os.path.exists(os.path.join("cache", "hunter")):
             os.mkdir(os.path.join("cache", "hunter"))
+        if not os.path.exists(os.path.join("cache", "recordings")):
+            os.mkdir(os.path.join("cache", "recordings"))
 
-        self.run()
+        return self.run()
 
 
 for x in range(3):
     t = TWB()
     path = '.'; 
     try:
-        if ('git' in sys.modules and Git.is_git_repo(path)):
+        if ('git' in sys.modules and "--replay" not in sys.argv and Git.is_git_repo(path)):
             repo = Repo(path)
             repo.remotes.origin.fetch()
             current_commit_hash = repo.git.rev_parse("HEAD")
@@ -443,7 +575,8 @@ for x in range(3):
                 if(response == "Y"):
                     repo.remotes.origin.pull()
 
-        t.start()
+        if t.start() and t.replay_path:
+            break
     except Exception as e:
         t.wrapper.reporter.report(0, "TWB_EXCEPTION", str(e))
         t.wrapper.discord.send("TWB crashed, check logs for more information - %s" % str(e))
@@ -0,0 +1,194 @@
+"""
+Parse time benchmark for core/extractors.py
+
+Pages come from a --record archive (cache/recordings/*.jsonl.gz) or a directory of saved pages named
+after their screen (overview.html, main.html, place.html, report.html, market.html, scavenge.html, map.html).
+A small set of saved pages is kept in tests/pages, tests/test_extractors.py runs the extractors over them.
+
+python -m utilities.benchmark <archive or directory> [--rounds 20] [--save result.json] [--compare result.json] [--json]
+
+With --compare the run fails when an extractor got more than 20% slower than the saved result.
+--json compares the stdlib decoder with core.extractors.json_loads (orjson when installed) on the embedded payloads.
+"""
+import gzip
+import json
+import os
+import sys
+import time
+from urllib.parse import urlparse, parse_qs
+
+from core import extractors
+from core.extractors import Extractor
+
+# Extractors run on every page on top of the screen specific ones
+COMMON = ["parse_csrf_token", "parse_h", "parse_game_state"]
+
+EXTRACTORS = {
+    "overview": [
+        "parse_units_in_village",
+        "parse_active_attacks",
+        "get_quests",
+        "get_quest_rewards",
+    ],
+    "main": ["building_data", "new_active_building_queue", "active_building_queue"],
+    "place": ["units_in_total", "attack_form", "attack_duration"],
+    "scavenge": ["village_data", "scavenge_options"],
+    "report": ["report_table"],
+    "market": ["premium_data", "premium_exchange_rate", "merchants_available"],
+    "map": ["map_data"],
+    "barracks": ["recruit_data", "active_recruit_queue"],
+    "stable": ["recruit_data", "active_recruit_queue"],
+    "garage": ["recruit_data", "active_recruit_queue"],
+    "smith": ["smith_data"],
+    "map_sectors": [],
+    "overview_villages": [
+        "village_ids_from_overview",
+        "production_overview",
+        "units_overview",
+        "incomings_overview",
+    ],
+}
+
+MAX_SLOWDOWN = 1.2
+
+
+# JSON blobs embedded in the pages, decoded by json_loads
+PAYLOADS = [
+    extractors.GAME_DATA,
+    extractors.MAP_DATA,
+    extractors.BUILDING_DATA,
+    extractors.SMITH_DATA,
+    extractors.PREMIUM_DATA,
+]
+
+
+def page_kind(url):
+    parsed = urlparse(url)
+    if parsed.path.endswith("map.php"):
+        return "map_sectors"
+    query = parse_qs(parsed.query)
+    screen = query.get("screen", [None])[0]
+    if screen == "place" and query.get("mode", [None])[0] == "scavenge":
+        return "scavenge"
+    return screen
+
+
+def load_pages(path):
+    pages = {}
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".html"):
+                with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+                    pages.setdefault(name.replace(".html", ""), []).append(f.read())
+        return pages
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            kind = page_kind(entry["final_url"])
+            if kind in EXTRACTORS and entry["body"]:
+                pages.setdefault(kind, []).append(entry["body"])
+    return pages
+
+
+def run(pages, rounds):
+    results = {}
+    for kind, bodies in pages.items():
+        for name in COMMON + EXTRACTORS.get(kind, []):
+            extractor = getattr(Extractor, name)
+            started = time.perf_counter()
+            for _ in range(rounds):
+                for body in bodies:
+                    try:
+                        extractor(body)
+                    except (AttributeError, KeyError, TypeError, ValueError):
+                        # Page does not contain this part, parsing up to the failure still counts
+                        pass
+            elapsed = time.perf_counter() - started
+            results["%s.%s" % (kind, name)] = elapsed / (rounds * len(bodies)) * 1000
+    return results
+
+
+def payloads(pages):
+    output = []
+    for kind, bodies in pages.items():
+        for body in bodies:
+            if kind == "map_sectors":
+                output.append(body)
+                continue
+            for pattern in PAYLOADS:
+                found = pattern.search(body)
+                if found:
+                    output.append(found.group(1))
+    return output
+
+
+def run_json(pages, rounds):
+    blobs = payloads(pages)
+    if not blobs:
+        print("No JSON payloads found")
+        return
+    size = sum(len(x) for x in blobs)
+    timings = {}
+    for name, decoder in [
+        ("stdlib", lambda x: json.loads(x, strict=False)),
+        ("json_loads", extractors.json_loads),
+    ]:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for blob in blobs:
+                decoder(blob)
+        timings[name] = (time.perf_counter() - started) / rounds * 1000
+    print(
+        "%d payloads (%d kB), orjson %s"
+        % (len(blobs), size / 1024, "installed" if extractors.has_orjson else "not installed")
+    )
+    for name, elapsed in timings.items():
+        print("%-50s %8.3f ms" % ("json." + name, elapsed))
+    print("Speedup: %.2fx" % (timings["stdlib"] / timings["json_loads"]))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 1
+    rounds = 20
+    if "--rounds" in sys.argv:
+        rounds = int(sys.argv[sys.argv.index("--rounds") + 1])
+    pages = load_pages(sys.argv[1])
+    print(
+        "Loaded %d pages (%s)"
+        % (sum(len(x) for x in pages.values()), ", ".join(sorted(pages)))
+    )
+    if "--json" in sys.argv:
+        run_json(pages, rounds)
+        return 0
+    results = run(pages, rounds)
+    baseline = {}
+    if "--compare" in sys.argv:
+        with open(sys.argv[sys.argv.index("--compare") + 1], "r") as f:
+            baseline = json.load(f)
+
+    failed = 0
+    for key in sorted(results):
+        line = "%-50s %8.3f ms" % (key, results[key])
+        if key in baseline and baseline[key] > 0:
+            ratio = results[key] / baseline[key]
+            line += "  %6.2fx" % ratio
+            if ratio > MAX_SLOWDOWN:
+                line += "  SLOWER"
+                failed += 1
+        print(line)
+
+    if "--save" in sys.argv:
+        with open(sys.argv[sys.argv.index("--save") + 1], "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if failed:
+        print("%d extractors got slower than the baseline" % failed)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -36,9 +36,8 @@ help_file = {
     "farms.max_points": "The maximum points of villages to attack (also checks custom_farms)",
     "farms.find_player_owned": "Automatically attacks all player owned villages (dangerous)",
     "farms.search_radius": "Max radius of villages to attack (fields)",
-    "farms.default_away_time": "Default time in seconds to sleep before attacking a village again",
-    "farms.full_loot_away_time": "Away time for villages with high resource gain",
-    "farms.low_loot_away_time": "Away time for villages with low resource gain",
+    "farms.default_away_time": "Time in seconds to wait after the troops are back before attacking a village scouted empty again",
+    "farms.low_loot_away_time": "Time in seconds to wait after the troops are back before attacking a village with low resource gain again",
     "farms.max_farms": "The amount of nearby villages to check",
     "farms.attack_higher_points": "If enabled villages with higher points than the current one will automatically be ignored",
     "farms.force_scout_if_available": "Will only attack villages that have either been attacked before or it will automatically scout them",
@@ -65,7 +64,7 @@ help_file = {
     "village.prioritize_snob": "Do not recruit if the snob does not have enough resources",
     "village.trade_for_premium": "Trade left-over resources for premium points (requires the global option to be enabled)",
     "village.gather_enabled": "Uses left-over units to gather additional resources if the option is enabled on the world",
-    "village.gather_selection": "The gather operation to preform (they have to be unlocked first)",
+    "village.gather_selection": "The highest gather operation to use, all unlocked operations up to it are started (they have to be unlocked first)",
     "village.snobs": "The amount of snobs to create in the current village",
     "village.evacuate_fragile_units_on_attack": "Automatically evacuate fragile units (axe, snob) to nearby safe villages in case of an attack",
     "village.support_others": "Allows the sending of automatic support",
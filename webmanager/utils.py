@@ -3,11 +3,23 @@ import json
 import collections
 import subprocess
 import psutil
+import sqlite3
 
 
 class DataReader:
     @staticmethod
     def cache_grab(cache_location):
+        db_path = os.path.join("../cache", "cache.db")
+        if os.path.exists(db_path):
+            # Bot cache lives in sqlite since the cache store migration
+            connection = sqlite3.connect(db_path)
+            try:
+                rows = connection.execute(
+                    "SELECT id, data FROM %s" % cache_location
+                ).fetchall()
+            finally:
+                connection.close()
+            return {key: json.loads(data) for key, data in rows}
         output = {}
         c_path = os.path.join("../cache", cache_location)
         for existing in os.listdir(c_path):